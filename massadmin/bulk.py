@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Set-based helpers used by MassAdmin to apply a mass change with a few SQL
+statements over the whole selection, instead of one form round trip per
+object.
+
+Each helper works on a queryset matching one batch of the selected objects
+(see `MassAdmin.mass_change_batch_size`), so that huge selections don't hit
+the database's parameters limit.
+"""
+
+import datetime
+import re
+from collections import defaultdict
+
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, models
+from django.db.models import F, Q, signals
+from django.db.models.sql import DeleteQuery
+from django.dispatch.dispatcher import _make_id
+from django.utils import timezone
+from django.utils.encoding import force_unicode
+
+from expressions import length_sql, replace_sql, Replace
+
+
+def chunked(items, size):
+    """
+    Yield successive lists of at most `size` elements from `items`.
+    """
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def keyset_chunked(queryset, size):
+    """
+    Yield successive lists of at most `size` primary keys of the objects
+    matching `queryset`, in primary key order.
+
+    Each list is fetched with its own query, starting after the last
+    primary key of the previous one, so that the whole list of primary
+    keys is never loaded at once.
+    """
+    queryset = queryset.order_by('pk')
+    pks = list(queryset.values_list('pk', flat=True)[:size])
+    while pks:
+        yield pks
+        pks = list(queryset.filter(pk__gt=pks[-1]).values_list('pk', flat=True)[:size])
+
+
+def is_overridden(klass, name, base):
+    """
+    Return True if `klass` provides its own version of method `name`
+    instead of the one inherited from `base`.
+    """
+    method = getattr(klass, name, None)
+    return getattr(method, 'im_func', method) is not getattr(base, name).im_func
+
+
+def has_listeners(signal, sender):
+    """
+    Return True if some receivers are connected to `signal` for `sender`.
+
+    `Signal.has_listeners` is not available on every Django version we
+    support, so fall back on the same check it does.
+    """
+    if hasattr(signal, 'has_listeners'):
+        return signal.has_listeners(sender)
+    return bool(signal._live_receivers(_make_id(sender)))
+
+
+def auto_now_values(model):
+    """
+    Return the values Model.save() would have set on `auto_now` date fields,
+    as QuerySet.update() does not handle them.
+    """
+    values = {}
+    for field in model._meta.local_fields:
+        if isinstance(field, models.DateField) and field.auto_now:
+            if isinstance(field, models.DateTimeField):
+                values[field.name] = timezone.now()
+            else:
+                values[field.name] = datetime.date.today()
+    return values
+
+
+def bulk_update(queryset, values):
+    """
+    Run `queryset.update(**values)`, also updating `auto_now` fields.
+
+    Return the number of updated rows.
+    """
+    return queryset.update(**dict(values, **auto_now_values(queryset.model)))
+
+
+def save_fields(obj, fieldnames):
+    """
+    Save the `fieldnames` columns of `obj` only, along with dates updated on
+    save, with an UPDATE of its row: Model.save() has no `update_fields`
+    argument before Django 1.5. pre_save and post_save are sent like
+    Model.save() does.
+    """
+    model = type(obj)
+    using = obj._state.db
+    signals.pre_save.send(sender=model, instance=obj, raw=False, using=using)
+    values = dict((field.name, field.pre_save(obj, False)) for field in model._meta.fields
+                  if field.name in fieldnames)
+    model._base_manager.using(using).filter(pk=obj.pk).update(**values)
+    signals.post_save.send(sender=model, instance=obj, created=False, raw=False, using=using)
+
+
+def empty_q(fieldname):
+    """
+    Return a Q object matching objects where `fieldname` is empty (NULL or
+    empty string).
+    """
+    return Q(**{'%s__isnull' % fieldname: True}) | Q(**{fieldname: ''})
+
+
+def bulk_define(queryset, fieldname, value):
+    """
+    Set `fieldname` to `value` on the objects of `queryset` where it is
+    empty (see `empty_q`).
+
+    Return the number of updated rows.
+    """
+    return bulk_update(queryset.filter(empty_q(fieldname)), {fieldname: value})
+
+
+def count_too_long(queryset, field, extra_length=0, replace=None):
+    """
+    Return how many objects of `queryset` would hold a value longer than
+    `field.max_length` once `extra_length` characters are added to `field`,
+    or once `replace`, a (find, replacement, regex) tuple, is applied on it
+    (see `expressions.replace_sql`).
+    """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(queryset.model._meta.db_table), qn(field.column))
+    params = []
+    if replace is not None:
+        find, replacement, regex = replace
+        column = replace_sql(connection, column, regex)
+        params += [find, replacement]
+    where = '%s > %%s' % length_sql(connection, column)
+    params.append(field.max_length - extra_length)
+    return queryset.extra(where=[where], params=params).count()
+
+
+def matching_condition(queryset, field, find, regex=False):
+    """
+    Return the condition matching objects of `queryset` where `field`
+    contains `find` (a regular expression if `regex` is True), as accepted
+    by `count_matching`.
+
+    Plain text is found with the REPLACE() function that replaces it, as
+    `contains` lookups are case-insensitive on some databases (like SQLite)
+    while REPLACE() is not.
+    """
+    if regex:
+        return Q(**{'%s__regex' % field.name: find})
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(queryset.model._meta.db_table), qn(field.column))
+    return '%s <> %s' % (replace_sql(connection, column), column), [find, '']
+
+
+def filter_matching(queryset, field, find, regex=False):
+    """
+    Return the objects of `queryset` where `field` contains `find` (see
+    `matching_condition`).
+    """
+    condition = matching_condition(queryset, field, find, regex)
+    if isinstance(condition, Q):
+        return queryset.filter(condition)
+    sql, params = condition
+    return queryset.extra(where=[sql], params=params)
+
+
+def bulk_find_replace(queryset, field, find, replacement, regex=False):
+    """
+    Replace all occurrences of `find` (a regular expression if `regex` is
+    True) by `replacement` in `field`, on the objects of `queryset` where
+    `find` matches.
+
+    This is done with a single UPDATE when the database can do the
+    replacement itself. Otherwise, only the primary key and the value of
+    matching objects are fetched, and changed values are written back with
+    one UPDATE per distinct new value: as many as matching objects in the
+    worst case, when every new value is different.
+
+    Raise ValueError if some new value would exceed `field.max_length`.
+    Return the number of updated rows.
+    """
+    connection = connections[queryset.db]
+    matching = filter_matching(queryset, field, find, regex)
+
+    if replace_sql(connection, '', regex) is not None:
+        if field.max_length is not None:
+            too_long = count_too_long(matching, field, replace=(find, replacement, regex))
+            if too_long:
+                raise ValueError('Field %s would exceed its maximum length (%s) on %s of the selected objects.' % (field.name, field.max_length, too_long))
+        return bulk_update(matching, {field.name: Replace(F(field.name), find, replacement, regex)})
+
+    pattern = re.compile(find)
+    # Primary keys of changed objects, by new value
+    new_values = defaultdict(list)
+    for pk, value in matching.values_list('pk', field.name):
+        new_value = pattern.sub(replacement, value)
+        if new_value == value:
+            continue
+        if field.max_length is not None and len(new_value) > field.max_length:
+            raise ValueError('Field %s would exceed its maximum length (%s) on object %s.' % (field.name, field.max_length, pk))
+        new_values[new_value].append(pk)
+    for new_value, pks in new_values.items():
+        bulk_update(queryset.filter(pk__in=pks), {field.name: new_value})
+    return sum(len(pks) for pks in new_values.values())
+
+
+def count_matching(queryset, conditions):
+    """
+    Return the number of objects of `queryset`, followed by the number of
+    them matching each of `conditions`, with a single
+    `SELECT COUNT(*), SUM(CASE WHEN ... THEN 1 ELSE 0 END), ...` query.
+
+    Conditions are either Q objects on the columns of the model, or (SQL,
+    parameters) couples referencing its table.
+    """
+    model = queryset.model
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    selects = ['COUNT(*)']
+    params = []
+    for condition in conditions:
+        if isinstance(condition, Q):
+            query = model._default_manager.filter(condition).query
+            sql, condition_params = query.where.as_sql(query.get_compiler(queryset.db).quote_name_unless_alias, connection)
+        else:
+            sql, condition_params = condition
+        selects.append('SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % sql)
+        params.extend(condition_params)
+    subquery, subquery_params = queryset.order_by().values('pk').query.get_compiler(queryset.db).as_sql()
+    table = qn(model._meta.db_table)
+    sql = 'SELECT %s FROM %s WHERE %s.%s IN (%s)' % (', '.join(selects), table, table, qn(model._meta.pk.column), subquery)
+    cursor = connection.cursor()
+    cursor.execute(sql, params + list(subquery_params))
+    # SUM() of no rows is NULL
+    return [count or 0 for count in cursor.fetchone()]
+
+
+def log_changes(user_id, changes):
+    """
+    Log the changes of objects, given as (object, change message) couples,
+    with a single INSERT.
+    """
+    entries = [
+        LogEntry(user_id=user_id, content_type_id=ContentType.objects.get_for_model(obj).pk,
+                 object_id=unicode(obj.pk), object_repr=force_unicode(obj)[:200],
+                 action_flag=CHANGE, change_message=change_message)
+        for obj, change_message in changes
+    ]
+    if entries:
+        LogEntry.objects.bulk_create(entries)
+
+
+def bulk_create_related(queryset, fk, objects):
+    """
+    Create a copy of each of `objects`, unsaved instances of the model of
+    foreign key `fk`, related to each object of `queryset`, with a single
+    INSERT.
+
+    Return the number of created objects.
+    """
+    model = fk.model
+    fields = [f for f in model._meta.local_fields if not isinstance(f, models.AutoField) and f is not fk]
+    rows = [
+        model(**dict([(f.attname, getattr(obj, f.attname)) for f in fields], **{fk.attname: value}))
+        for value in queryset.values_list(fk.rel.field_name, flat=True)
+        for obj in objects
+    ]
+    if rows:
+        model._default_manager.bulk_create(rows)
+    return len(rows)
+
+
+def delete_queryset(queryset):
+    """
+    Delete the rows matched by `queryset` with a single DELETE statement.
+
+    Unlike `QuerySet.delete()`, instances are not collected first, so this
+    is only done when no receivers expect delete signals for them.
+    """
+    model = queryset.model
+    if has_listeners(signals.pre_delete, model) or has_listeners(signals.post_delete, model):
+        queryset.delete()
+    else:
+        if not queryset.query.where:
+            # DeleteQuery always writes a WHERE clause
+            queryset = queryset.filter(pk__isnull=False)
+        DeleteQuery(model).do_query(model._meta.db_table, queryset.query.where, using=queryset.db)
+
+
+def _get_m2m_columns(field):
+    """
+    Return the names of the source and target columns of the relations
+    table of many-to-many field `field`.
+    """
+    through = field.rel.through
+    return (through._meta.get_field(field.m2m_field_name()).attname,
+            through._meta.get_field(field.m2m_reverse_field_name()).attname)
+
+
+def bulk_m2m(queryset, field, targets, only_empty=False, replace=False, remove=False, send_signals=True):
+    """
+    Relate the objects of `queryset` to `targets` through many-to-many
+    field `field`, working on the relations table directly: existing
+    relations are fetched with a single query and compared in memory with
+    `targets`, then missing ones are inserted with a single INSERT and, if
+    `replace` is True, obsolete ones are removed with a single DELETE.
+    If `only_empty` is True, objects already having relations are left
+    untouched.
+    If `remove` is True, existing relations to `targets` are removed
+    instead.
+
+    m2m_changed is still sent for each changed object, around those
+    queries, unless `send_signals` is False.
+
+    Return the set of primary keys of changed objects.
+    """
+    through = field.rel.through
+    source, target = _get_m2m_columns(field)
+    target_ids = set(obj.pk for obj in targets)
+    send_signals = send_signals and has_listeners(signals.m2m_changed, through)
+    if send_signals:
+        instances = dict((obj.pk, obj) for obj in queryset)
+    else:
+        instances = dict.fromkeys(queryset.values_list('pk', flat=True))
+
+    existing = defaultdict(set)
+    relations = through._default_manager.filter(**{'%s__in' % source: instances.keys()})
+    for source_id, target_id in relations.values_list(source, target):
+        existing[source_id].add(target_id)
+
+    added, removed = {}, {}
+    for pk in instances:
+        current = existing[pk]
+        if only_empty and current:
+            continue
+        if remove:
+            if current & target_ids:
+                removed[pk] = current & target_ids
+            continue
+        if target_ids - current:
+            added[pk] = target_ids - current
+        if replace and current - target_ids:
+            removed[pk] = current - target_ids
+
+    def send(action, pk_sets):
+        if send_signals:
+            for pk, pk_set in pk_sets.items():
+                signals.m2m_changed.send(sender=through, action=action, instance=instances[pk], reverse=False,
+                                         model=field.rel.to, pk_set=pk_set, using=queryset.db)
+
+    if removed:
+        send('pre_remove', removed)
+        obsolete = through._default_manager.filter(**{'%s__in' % source: removed.keys()})
+        if remove:
+            obsolete = obsolete.filter(**{'%s__in' % target: target_ids})
+        elif target_ids:
+            obsolete = obsolete.exclude(**{'%s__in' % target: target_ids})
+        delete_queryset(obsolete)
+        send('post_remove', removed)
+    if added:
+        send('pre_add', added)
+        through._default_manager.bulk_create([
+            through(**{source: pk, target: target_id})
+            for pk, pk_set in added.items() for target_id in pk_set
+        ])
+        send('post_add', added)
+    return set(added) | set(removed)
+
+
+def bulk_m2m_remove(queryset, field, targets, send_signals=True):
+    """
+    Remove relations between the objects of `queryset` and `targets`
+    through many-to-many field `field`, with a single DELETE on the
+    relations table. Objects are not even loaded, unless m2m_changed
+    receivers need them and `send_signals` is True (in which case see
+    `bulk_m2m`).
+
+    Return the set of primary keys of changed objects.
+    """
+    through = field.rel.through
+    if send_signals and has_listeners(signals.m2m_changed, through):
+        return bulk_m2m(queryset, field, targets, remove=True)
+    source, target = _get_m2m_columns(field)
+    target_ids = [obj.pk for obj in targets]
+    if not target_ids:
+        return set()
+    obsolete = through._default_manager.filter(**{
+        '%s__in' % source: queryset.values('pk'),
+        '%s__in' % target: target_ids,
+    })
+    changed = set(obsolete.values_list(source, flat=True))
+    if changed:
+        delete_queryset(obsolete)
+    return changed
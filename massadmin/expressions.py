@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Query expressions used to compute mass changed values in the database.
+"""
+
+from django.db.models.expressions import ExpressionNode
+
+
+def length_sql(connection, sql):
+    """
+    Wrap `sql` in the SQL function returning its length in characters,
+    NULL being counted as an empty string.
+    """
+    function = connection.vendor == 'mysql' and 'CHAR_LENGTH' or 'LENGTH'
+    return "%s(COALESCE(%s, ''))" % (function, sql)
+
+
+class Concat(ExpressionNode):
+    """
+    Concatenation of field references (`F` objects) and plain strings, NULL
+    values being handled as empty strings.
+
+    `Concat(F('name'), u' II')` evaluates to `name || ' II'` (or
+    `CONCAT(name, ' II')` on MySQL).
+    """
+    CONCAT = '||'
+
+    def __init__(self, *expressions):
+        super(Concat, self).__init__(list(expressions), self.CONCAT)
+
+    def evaluate(self, evaluator, qn, connection):
+        expressions = []
+        expression_params = []
+        for child in self.children:
+            if hasattr(child, 'evaluate'):
+                sql, params = child.evaluate(evaluator, qn, connection)
+            else:
+                sql, params = '%s', (child,)
+            expressions.append("COALESCE(%s, '')" % sql)
+            expression_params.extend(params)
+        if connection.vendor == 'mysql':
+            return 'CONCAT(%s)' % ', '.join(expressions), expression_params
+        return '(%s)' % ' || '.join(expressions), expression_params
+
+
+def replace_sql(connection, sql, regex=False):
+    """
+    Wrap `sql` in the SQL function replacing occurrences of the string (or
+    regular expression, if `regex` is True) given as first parameter by the
+    string given as second parameter.
+
+    Return None if the database can't replace regular expressions.
+    """
+    if not regex:
+        return 'REPLACE(%s, %%s, %%s)' % sql
+    if connection.vendor == 'postgresql':
+        return "REGEXP_REPLACE(%s, %%s, %%s, 'g')" % sql
+    if connection.vendor == 'oracle':
+        return 'REGEXP_REPLACE(%s, %%s, %%s)' % sql
+    return None
+
+
+class Replace(ExpressionNode):
+    """
+    Replacement of all occurrences of `find` by `replacement` in the value
+    of `expression` (see `replace_sql`).
+
+    `Replace(F('url'), u'http://', u'https://')` evaluates to
+    `REPLACE(url, 'http://', 'https://')`.
+    """
+    REPLACE = 'REPLACE'
+
+    def __init__(self, expression, find, replacement, regex=False):
+        super(Replace, self).__init__([expression, find, replacement], self.REPLACE)
+        self.regex = regex
+
+    def __deepcopy__(self, memodict):
+        obj = super(Replace, self).__deepcopy__(memodict)
+        obj.regex = self.regex
+        return obj
+
+    def evaluate(self, evaluator, qn, connection):
+        expression, find, replacement = self.children
+        sql, params = expression.evaluate(evaluator, qn, connection)
+        return replace_sql(connection, sql, self.regex), tuple(params) + (find, replacement)
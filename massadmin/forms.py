@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import re
+
 from django import forms
 from django.forms import widgets
 from django.utils.translation import ugettext_lazy as _
@@ -10,13 +12,24 @@ CHARFIELD_ACTIONS = Choices(
     ('DEFINE', 'define', _('Define (if empty)')),
     ('REPLACE', 'replace', _('Replace')),
     ('PREPEND', 'prepend', _('Add before')),
-    ('APPEND', 'append', _('Add after'))
+    ('APPEND', 'append', _('Add after')),
+    ('FIND_REPLACE', 'find_replace', _('Find and replace')),
 )
 
 MULTI_ACTIONS = Choices(
     ('DEFINE', 'define', _('Define (if empty)')),
     ('REPLACE', 'replace', _('Replace')),
     ('ADD', 'add', _('Add')),
+    ('REMOVE', 'remove', _('Remove')),
+)
+
+NUMERIC_ACTIONS = Choices(
+    ('REPLACE', 'replace', _('Replace')),
+    ('ADD', 'add', _('Add')),
+    ('SUBTRACT', 'subtract', _('Subtract')),
+    ('MULTIPLY', 'multiply', _('Multiply by')),
+    ('MIN', 'min', _('At least')),
+    ('MAX', 'max', _('At most')),
 )
 
 
@@ -30,13 +43,17 @@ class MassOptionsForField(forms.Form):
     field/inline.
     If given field is a CharField and its widget is not
     a sub-instance of MultiWidget, expose more advanced options like
-    'prepend', 'append', 'empty', etc.
+    'prepend', 'append', 'empty', etc. For 'find and replace', the text
+    (or regular expression) to find is given in an extra text input.
+    If given field is a numeric field, expose arithmetic options ('add',
+    'multiply', etc.).
 
     Note: it also works for inlines. In that case, only `field_name` is given
     in the extra kwargs.
     """
     CHARFIELD_ACTIONS = CHARFIELD_ACTIONS
     MULTI_ACTIONS = MULTI_ACTIONS
+    NUMERIC_ACTIONS = NUMERIC_ACTIONS
 
     def __init__(self, *args, **kwargs):
         self.model_field_name = kwargs.pop('field_name')
@@ -60,7 +77,27 @@ class MassOptionsForField(forms.Form):
             mass_field_name = self.get_mass_field_name()
             choices = self.get_actions_choices()
             if choices:
-                self.fields[mass_field_name + '_action'] = forms.ChoiceField(choices=choices, label=_('Advanced operations'))
+                # Missing when the field widget was not loaded (see
+                # `MassAdmin.mass_change_lazy_widgets`)
+                self.fields[mass_field_name + '_action'] = forms.ChoiceField(choices=choices, required=False, label=_('Advanced operations'))
+            if choices is self.CHARFIELD_ACTIONS:
+                self.fields[mass_field_name + '_find'] = forms.CharField(required=False, label=_('Find'))
+                self.fields[mass_field_name + '_regex'] = forms.BooleanField(required=False, label=_('Regular expression'))
+
+    def clean(self):
+        cleaned_data = self.cleaned_data
+        mass_field_name = self.get_mass_field_name()
+        if (cleaned_data.get(mass_field_name)
+                and cleaned_data.get(mass_field_name + '_action') == self.CHARFIELD_ACTIONS.FIND_REPLACE):
+            find = cleaned_data.get(mass_field_name + '_find')
+            if not find:
+                raise forms.ValidationError(_('Text to find is required.'))
+            if cleaned_data.get(mass_field_name + '_regex'):
+                try:
+                    re.compile(find)
+                except re.error, e:
+                    raise forms.ValidationError(_('Invalid regular expression: %s') % e)
+        return cleaned_data
 
     def get_actions_choices(self):
         """
@@ -77,9 +114,20 @@ class MassOptionsForField(forms.Form):
             choices = self.CHARFIELD_ACTIONS
         elif isinstance(self.model_field, forms.ModelMultipleChoiceField):
             choices = self.MULTI_ACTIONS
+        elif isinstance(self.model_field, (forms.IntegerField, forms.FloatField, forms.DecimalField)):
+            choices = self.NUMERIC_ACTIONS
         else:
             choices = None
         return choices
 
     def get_mass_field_name(self):
         return '_mass_change_' + self.model_field_name
+
+    def get_find_options(self):
+        """
+        Return the text to find for 'find and replace' action, and whether
+        it is a regular expression.
+        """
+        mass_field_name = self.get_mass_field_name()
+        return (self.cleaned_data.get(mass_field_name + '_find'),
+                self.cleaned_data.get(mass_field_name + '_regex', False))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Local workers running mass change jobs (see `MassAdmin.mass_change_job_threshold`).
+
+Jobs are either run one after the other by a thread of the web server
+process (`enqueue`), or by the `run_mass_change_jobs` management command
+(`run_pending_jobs`). No message broker is needed in either case.
+"""
+
+import logging
+import Queue
+import threading
+
+from django.contrib import admin
+from django.db import connection
+
+from models import MassChangeJob
+
+_queue = Queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+logger = logging.getLogger('massadmin')
+
+
+def run_job(job, model_admin=None):
+    """
+    Run `job` with `model_admin`, defaulting to the MassAdmin registered
+    for its model on the default admin site.
+
+    Return False if the job was not run, as another worker (a thread or a
+    `run_mass_change_jobs` command) claimed it first.
+    """
+    if model_admin is None:
+        model_admin = admin.site._registry[job.content_type.model_class()]
+    return model_admin.run_mass_change_job(job)
+
+
+def run_pending_jobs():
+    """
+    Run pending jobs, oldest first, and return how many were run.
+    """
+    count = 0
+    for job in MassChangeJob.objects.filter(status=MassChangeJob.PENDING):
+        if run_job(job):
+            count += 1
+    return count
+
+
+def _work():
+    while True:
+        job_id, model_admin = _queue.get()
+        try:
+            run_job(MassChangeJob.objects.get(pk=job_id), model_admin)
+        except Exception:
+            # Errors of the mass change itself are stored on the job
+            logger.exception('Mass change job %s could not be run', job_id)
+        finally:
+            # Do not keep a connection open in an idle thread
+            connection.close()
+            _queue.task_done()
+
+
+def enqueue(job, model_admin):
+    """
+    Run `job` with `model_admin` in the worker thread, starting it if
+    needed.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='massadmin-jobs')
+            _worker.daemon = True
+            _worker.start()
+    _queue.put((job.pk, model_admin))
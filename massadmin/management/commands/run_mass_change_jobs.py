@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib import admin
+from django.core.management.base import NoArgsCommand
+
+from massadmin.jobs import run_pending_jobs
+
+
+class Command(NoArgsCommand):
+    help = 'Run pending mass change jobs.'
+
+    def handle_noargs(self, **options):
+        admin.autodiscover()
+        count = run_pending_jobs()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%s mass change job(s) run.\n' % count)
@@ -29,50 +29,165 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-from copy import deepcopy
+from copy import copy
+from functools import partial
+import hashlib
+import re
+import time
 import urllib
 
 from django.contrib import admin
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.admin.util import display_for_field
+from django.contrib.admin.views.main import ALL_VAR, ORDER_VAR, PAGE_VAR
+from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
 from django.conf.urls.defaults import patterns, url
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.core.exceptions import PermissionDenied
-from django.db import transaction
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import connections, transaction, DatabaseError
 from django.db import models
-from django.contrib.admin import helpers
-from django.utils.translation import ugettext as _
+from django.db.models import F, Q
+from django.db.models.query import QuerySet
+from django import forms
+from django.core.validators import MaxLengthValidator
+from django.contrib.admin import helpers, widgets
+from django.utils.translation import ugettext as _, get_language
 from django.utils.encoding import force_unicode
+from django.utils.text import capfirst, get_text_list
 from django.utils.safestring import mark_safe
 from django.template.defaultfilters import pluralize
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseRedirect, QueryDict
 from django import  template
 from django.shortcuts import render_to_response
 from django.forms.formsets import all_valid
+from django.forms.models import BaseModelForm
+from django.db.models import signals
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.utils.datastructures import MultiValueDict, SortedDict
 
 from forms import MassOptionsForField
+from expressions import Concat, length_sql, replace_sql
+from metrics import MassChangeMetrics, NoMetrics
+from models import MassChangeJob
+from plan import MassChangePlan
+from signals import pre_mass_change, post_mass_change, mass_change_metrics
+import bulk
+import jobs
+import selection
 
 import sys
 
 
+NUMERIC_FIELDS = (models.IntegerField, models.FloatField, models.DecimalField)
+NUMERIC_FORM_FIELDS = (forms.IntegerField, forms.FloatField, forms.DecimalField)
+
+# Changes each time the process is started, so that cached parts of the mass
+# change form are not used anymore once a new version is deployed.
+_PROCESS_TOKEN = repr(time.time())
+
+
 class MassAdmin(admin.ModelAdmin):
     actions = ['mass_change_selected']
     mass_change_form_template = None
     mass_actions_options_form = MassOptionsForField
+    # When possible, apply the mass change with a single UPDATE statement
+    # per batch of `mass_change_batch_size` objects, instead of saving
+    # each object through its own ModelForm.
+    mass_change_bulk_update = True
+    # Selected objects are loaded and changed by batches of this size.
+    mass_change_batch_size = 500
+    # Commit each batch as soon as it is processed, instead of doing the
+    # whole mass change in a single transaction.
+    mass_change_commit_per_batch = False
+    # Number of seconds a selection of objects to mass change is kept in
+    # the session.
+    mass_change_selection_timeout = 60 * 60
+    # Mass changes of at least this number of objects are not applied in
+    # the admin request, but saved as a MassChangeJob run by a local worker
+    # (None to never do so).
+    mass_change_job_threshold = None
+    # Run jobs in a thread of the current process. Otherwise, they are run
+    # by the `run_mass_change_jobs` management command.
+    mass_change_jobs_in_thread = True
+    # Relations followed by changed objects' __unicode__ (which is used to
+    # log changes), to load them along with the objects.
+    mass_change_select_related = ()
+    # Log a mass change with a single entry referencing the selection,
+    # instead of one entry per changed object.
+    mass_change_log_summary = False
+    # Do not send per object signals (pre_save, post_save, m2m_changed) when
+    # receivers of batch signals (see `massadmin.signals`) are connected for
+    # the model, so that objects can be changed in bulk anyway.
+    mass_change_suppress_row_signals = False
+    # Store a copy of an uploaded file for each changed object, instead of
+    # storing it once and sharing it between all of them.
+    mass_change_copy_files = False
+    # Validate submitted inline objects once, and create them for all the
+    # changed objects with one INSERT per batch, instead of validating and
+    # saving inline formsets object by object.
+    mass_change_bulk_inlines = False
+    # Number of selected objects shown with their current and new values
+    # in the preview of a mass change.
+    mass_change_preview_samples = 5
+    # Only render the "mass change" checkboxes of the mass change form: the
+    # widget and options of a field are loaded once its checkbox is checked
+    # (see `mass_change_field_view`).
+    mass_change_lazy_widgets = False
+    # Foreign keys and many-to-many fields relating to more than this number
+    # of objects are edited with raw id widgets in the mass change form,
+    # instead of rendering every choice (None to never do so).
+    mass_change_raw_id_threshold = 1000
+    # Number of seconds the parts of the mass change form which don't depend
+    # on the selection are cached (see `get_mass_change_cache_key`), 0 to
+    # not cache them.
+    mass_change_cache_timeout = 60 * 60
+    # Lock each batch of selected objects (SELECT ... FOR UPDATE) in primary
+    # key order before changing it, so that concurrent mass changes wait for
+    # each other instead of deadlocking. Along with
+    # `mass_change_commit_per_batch`, locks are only held for one batch.
+    mass_change_lock_rows = False
+    # When locking rows, skip (and report) the ones locked by another
+    # transaction instead of waiting for them. This needs a database
+    # supporting NOWAIT, rows are waited for otherwise.
+    mass_change_skip_locked = False
 
     def get_urls(self):
         urls = super(MassAdmin, self).get_urls()
         info = self.model._meta.app_label, self.model._meta.module_name
         custom_urls = patterns('',
-            url(r'^masschange/(?P<object_ids>[0-9,]+)/$',
+            url(r'^masschange/(?P<token>\w+)/$',
                 self.admin_site.admin_view(self.mass_change_view),
-                name='%s_%s_massadmin' % info)
+                name='%s_%s_massadmin' % info),
+            url(r'^masschange/job/(?P<job_id>\d+)/$',
+                self.admin_site.admin_view(self.mass_change_job_view),
+                name='%s_%s_massadmin_job' % info),
+            url(r'^masschange/job/(?P<job_id>\d+)/status/$',
+                self.admin_site.admin_view(self.mass_change_job_status_view),
+                name='%s_%s_massadmin_job_status' % info),
+            url(r'^masschange/field/(?P<field_name>\w+)/$',
+                self.admin_site.admin_view(self.mass_change_field_view),
+                name='%s_%s_massadmin_field' % info),
         )
         return custom_urls + urls
 
     def mass_change_selected(self, request, queryset):
-        selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
         info = self.model._meta.app_label, self.model._meta.module_name
-        selected = ','.join(selected)
-        massadmin_url = reverse('admin:%s_%s_massadmin' % info, args=(selected,), current_app=self.admin_site.name)
+        if request.POST.get('select_across') == '1':
+            # All objects matching the changelist filters are selected:
+            # store the filters, not the (maybe huge) list of objects.
+            # Pagination and ordering don't change the selection.
+            filters = request.GET.copy()
+            for param in (PAGE_VAR, ALL_VAR, ORDER_VAR):
+                if param in filters:
+                    del filters[param]
+            token = selection.save_filters(request, self.model, filters.urlencode(), self.mass_change_selection_timeout)
+        else:
+            selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+            token = selection.save_selection(request, self.model, selected, self.mass_change_selection_timeout)
+        massadmin_url = reverse('admin:%s_%s_massadmin' % info, args=(token,), current_app=self.admin_site.name)
 
         next = urllib.quote(request.get_full_path())
 
@@ -81,15 +196,90 @@ class MassAdmin(admin.ModelAdmin):
         return HttpResponseRedirect(massadmin_url)
     mass_change_selected.short_description = _('Mass change selected')
 
-    def response_mass_change(self, request, obj):
-        opts = obj._meta
+    def response_mass_change(self, request, obj, defined=None, counts=None):
+        """
+        `defined` optionally gives, for fields handled with the "define (if
+        empty)" action, the number of objects where they were defined.
+        `counts` optionally gives the number of objects that were changed,
+        and the number of objects left untouched as they were up to date.
+        """
+        opts = self.model._meta
         msg = _('Selected %(name)s were changed successfully.') % {'name': force_unicode(opts.verbose_name_plural), 'obj': force_unicode(obj)}
         self.message_user(request, msg)
+        metrics = getattr(request, 'mass_change_metrics', None)
+        if settings.DEBUG and isinstance(metrics, MassChangeMetrics):
+            self.message_user(request, _('Mass change metrics: %s') % metrics)
+        locked = getattr(request, 'mass_change_locked', None)
+        if locked:
+            msg = _('%(count)s %(name)s were skipped, as they were being changed by someone else.') % {
+                'count': len(locked),
+                'name': force_unicode(opts.verbose_name_plural)
+            }
+            self.message_user(request, msg)
+        if counts is not None:
+            msg = _('%(changed)s %(name)s changed, %(untouched)s already up to date.') % {
+                'changed': counts[0],
+                'untouched': counts[1],
+                'name': force_unicode(opts.verbose_name_plural)
+            }
+            self.message_user(request, msg)
+        for fieldname, count in (defined or {}).items():
+            msg = _('%(field)s was defined on %(count)s of the selected %(name)s.') % {
+                'field': capfirst(force_unicode(opts.get_field(fieldname).verbose_name)),
+                'count': count,
+                'name': force_unicode(opts.verbose_name_plural)
+            }
+            self.message_user(request, msg)
 
         next = request.GET.get('next', '../../')
 
         return HttpResponseRedirect(next)
 
+    def response_mass_change_job(self, request, job):
+        """
+        Render the page following the progress of `job`.
+        """
+        opts = self.model._meta
+        info = opts.app_label, opts.module_name
+        context = {
+            'title': _('Mass change of %(n_objects)s %(verbose_name)s%(plural)s') % {'n_objects': job.total, 'verbose_name': force_unicode(opts.verbose_name), 'plural': pluralize(job.total)},
+            'job': job,
+            'progress_url': reverse('admin:%s_%s_massadmin_job' % info, args=(job.pk,), current_app=self.admin_site.name),
+            'changelist_url': reverse('admin:%s_%s_changelist' % info, current_app=self.admin_site.name),
+            'opts': opts,
+            'app_label': opts.app_label,
+        }
+        context_instance = template.RequestContext(request, current_app=self.admin_site.name)
+        return render_to_response([
+            "admin/%s/%s/mass_change_job.html" % (opts.app_label, opts.object_name.lower()),
+            "admin/%s/mass_change_job.html" % opts.app_label,
+            "admin/mass_change_job.html"
+        ], context, context_instance=context_instance)
+
+    def response_mass_change_preview(self, request, preview):
+        """
+        Render the `preview` of the mass change submitted in `request` (see
+        `get_mass_change_preview`), with a form to apply it.
+        """
+        opts = self.model._meta
+        n_objects = preview['total']
+        context = {
+            'title': _('Mass change of %(n_objects)s %(verbose_name)s%(plural)s') % {'n_objects': n_objects, 'verbose_name': force_unicode(opts.verbose_name), 'plural': pluralize(n_objects)},
+            'preview': preview,
+            # Uploaded files can't be submitted again from the preview
+            'data': [(name, value) for name, values in request.POST.lists() for value in values
+                     if name not in ('_preview', 'csrfmiddlewaretoken')],
+            'has_file_field': bool(request.FILES),
+            'opts': opts,
+            'app_label': opts.app_label,
+        }
+        context_instance = template.RequestContext(request, current_app=self.admin_site.name)
+        return render_to_response([
+            "admin/%s/%s/mass_change_preview.html" % (opts.app_label, opts.object_name.lower()),
+            "admin/%s/mass_change_preview.html" % opts.app_label,
+            "admin/mass_change_preview.html"
+        ], context, context_instance=context_instance)
+
     def render_mass_change_form(self, request, context, obj=None):
         opts = self.model._meta
         app_label = opts.app_label
@@ -104,7 +294,7 @@ class MassAdmin(admin.ModelAdmin):
             'ordered_objects': ordered_objects,
             'opts': opts,
             'save_on_top': self.save_on_top,
-            'onclick_attrib': (opts.get_ordered_objects() and change and 'onclick="submitOrderForm();"' or ''),
+            'onclick_attrib': (ordered_objects and 'onclick="submitOrderForm();"' or ''),
         })
         context_instance = template.RequestContext(request, current_app=self.admin_site.name)
         return render_to_response(self.mass_change_form_template or [
@@ -114,124 +304,1046 @@ class MassAdmin(admin.ModelAdmin):
         ], context, context_instance=context_instance)
 
     def get_mass_form(self, request, obj=None):
-        return self.get_form(request, obj)
+        return self.get_form(request, obj, formfield_callback=partial(self.formfield_for_mass_change, request=request))
+
+    def formfield_for_mass_change(self, db_field, **kwargs):
+        """
+        Return the form field of `db_field` in the mass change form, as
+        returned by `formfield_for_dbfield`, except that relations to more
+        than `mass_change_raw_id_threshold` objects get a raw id widget, as
+        rendering all of their choices would be too slow.
+        """
+        formfield = self.formfield_for_dbfield(db_field, **kwargs)
+        threshold = self.mass_change_raw_id_threshold
+        if (formfield is not None and threshold is not None
+                and isinstance(db_field, (models.ForeignKey, models.ManyToManyField))
+                and db_field.name not in self.raw_id_fields):
+            if self._is_large_relation(db_field, threshold, kwargs.get('using')):
+                if isinstance(db_field, models.ForeignKey):
+                    widget = widgets.ForeignKeyRawIdWidget(db_field.rel, self.admin_site, using=kwargs.get('using'))
+                else:
+                    widget = widgets.ManyToManyRawIdWidget(db_field.rel, self.admin_site, using=kwargs.get('using'))
+                    formfield.help_text = ''
+                widget.is_required = formfield.required
+                formfield.widget = widget
+        return formfield
 
-    def mass_change_view(self, request, object_ids=None, extra_context=None):
+    def _get_formsets_with_prefixes(self, request, obj=None):
+        """
+        Yield (FormSet, prefix) couples for each inline, computing prefixes
+        the same way the admin does.
+        """
+        prefixes = {}
+        for FormSet in self.get_formsets(request, obj):
+            prefix = FormSet.get_default_prefix()
+            prefixes[prefix] = prefixes.get(prefix, 0) + 1
+            if prefixes[prefix] != 1:
+                prefix = "%s-%s" % (prefix, prefixes[prefix])
+            yield FormSet, prefix
+
+    def _is_inline_selected(self, request, prefix):
+        """
+        Check if inline formset identified by `prefix` has been selected
+        for mass change.
+        """
+        mass_options_form = self.mass_actions_options_form(data=request.POST, field_name=prefix)
+        if not mass_options_form.is_valid():
+            raise Exception('Mass options for inline %s are not valid: %s' % (prefix, mass_options_form.errors))
+        mass_field_name = mass_options_form.get_mass_field_name()
+        return mass_options_form.cleaned_data.get(mass_field_name, False)
+
+    def _get_bulk_actions(self, field, formfield):
+        """
+        Return the mass actions that can be computed in the database for
+        model field `field`, edited through form field `formfield`.
+        """
+        if isinstance(field, models.ManyToManyField):
+            ACTIONS = self.mass_actions_options_form.MULTI_ACTIONS
+            if not field.rel.through._meta.auto_created:
+                return []
+            return [ACTIONS.DEFINE, ACTIONS.REPLACE, ACTIONS.ADD, ACTIONS.REMOVE]
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        actions = [ACTIONS.REPLACE]
+        if isinstance(field, (models.CharField, models.TextField)) and isinstance(formfield, forms.CharField):
+            actions.append(ACTIONS.DEFINE)
+        if isinstance(field, NUMERIC_FIELDS) and isinstance(formfield, NUMERIC_FORM_FIELDS):
+            ACTIONS = self.mass_actions_options_form.NUMERIC_ACTIONS
+            # Bounds are kept while clamping, but results of arithmetic
+            # operations could only be validated once computed.
+            actions = [ACTIONS.REPLACE, ACTIONS.MIN, ACTIONS.MAX]
+            if not field.validators and not formfield.validators:
+                actions += [ACTIONS.ADD, ACTIONS.SUBTRACT]
+                if not isinstance(field, models.DecimalField):
+                    # A product could have more decimal places than allowed
+                    actions.append(ACTIONS.MULTIPLY)
+            return actions
+        if type(formfield) is forms.CharField and all(isinstance(v, MaxLengthValidator) for v in field.validators):
+            # Only the length of a plain string can be checked once the
+            # string is concatenated in the database.
+            actions += [ACTIONS.PREPEND, ACTIONS.APPEND, ACTIONS.FIND_REPLACE]
+        return actions
+
+    def _can_mass_change_in_bulk(self, request, plan):
+        """
+        Return True if the mass change can be done with a plain
+        `QuerySet.update()`, i.e. it would give the very same result as
+        saving each object through its form:
+          - each handled field is a plain model column that is not part of
+            a unique constraint (or a file field whose file was stored once,
+            see `mass_change_copy_files`), or a many-to-many relation whose
+            new value can be computed in the database (see
+            `_get_bulk_actions`);
+          - no inline is handled object by object (see
+            `mass_change_bulk_inlines`);
+          - nothing specific happens when validating or saving an object
+            (no custom clean/save methods, no pre_save/post_save receivers,
+            unless they are suppressed, see `_suppress_row_signals`).
+        """
+        if not self.mass_change_bulk_update:
+            return False
+        opts = self.model._meta
+        columns = dict((f.name, f) for f in opts.fields + opts.many_to_many)
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        ModelForm = plan.form_class
+        for fieldname in plan.fields:
+            field = columns.get(fieldname)
+            if field is None or (isinstance(field, models.FileField) and fieldname not in plan.cleaned_values):
+                return False
+            if isinstance(field, models.ImageField) and (field.width_field or field.height_field):
+                # Dimensions are only updated on objects
+                return False
+            if field.unique or any(fieldname in together for together in opts.unique_together):
+                # Uniqueness is checked object by object
+                return False
+            action = plan.get_action(fieldname, ACTIONS.REPLACE)
+            if action not in self._get_bulk_actions(field, ModelForm.base_fields[fieldname]):
+                return False
+        if plan.formsets:
+            return False
+        if (bulk.is_overridden(type(self), 'save_model', admin.ModelAdmin)
+                or bulk.is_overridden(type(self), 'save_form', admin.ModelAdmin)
+                or bulk.is_overridden(ModelForm, 'clean', BaseModelForm)
+                or bulk.is_overridden(ModelForm, 'save', BaseModelForm)
+                or bulk.is_overridden(self.model, 'clean', models.Model)
+                or bulk.is_overridden(self.model, 'save', models.Model)):
+            return False
+        if self._suppress_row_signals():
+            return True
+        return not (bulk.has_listeners(signals.pre_save, self.model)
+                    or bulk.has_listeners(signals.post_save, self.model))
+
+    def _suppress_row_signals(self):
+        """
+        Return True if per object signals are not sent in bulk, batch
+        signals being sent instead (see `mass_change_suppress_row_signals`).
+
+        Objects changed one by one are saved by Django, which always sends
+        its signals.
+        """
+        return self.mass_change_suppress_row_signals and (
+            bulk.has_listeners(pre_mass_change, self.model)
+            or bulk.has_listeners(post_mass_change, self.model))
+
+    def get_changelist_queryset(self, request, query_string):
+        """
+        Return the queryset of the changelist filtered and searched with
+        the parameters of `query_string`.
+
+        The changelist is neither paginated nor counted, as the page it
+        was displayed on may not exist anymore.
+        """
+        changelist_request = copy(request)
+        changelist_request.GET = QueryDict(query_string)
+        list_display = self.get_list_display(request)
+
+        class ChangeList(self.get_changelist(request)):
+            def get_results(self, request):
+                pass
+        cl = ChangeList(changelist_request, self.model, list_display,
+            self.get_list_display_links(request, list_display), self.list_filter,
+            self.date_hierarchy, self.search_fields, self.list_select_related,
+            self.list_per_page, self.list_max_show_all, self.list_editable,
+            self)
+        return cl.query_set
+
+    def _iter_batches(self, request, object_ids, plan):
+        """
+        Yield querysets matching the selected objects, by batches of
+        `mass_change_batch_size` objects ordered by primary key, along with
+        the primary keys of these objects.
+        `object_ids` is either the list of primary keys of the selected
+        objects, or a queryset matching them, in which case batches are
+        fetched one after the other (see `bulk.keyset_chunked`).
+
+        `pre_mass_change` and `post_mass_change` are sent around the
+        processing of each batch, for `plan`.
+
+        If `mass_change_commit_per_batch` is True, each batch is committed
+        once it has been processed, so that row locks are only held for one
+        batch and a failure only rolls back the current batch. Otherwise the
+        whole mass change is committed (or rolled back) at once.
+
+        If `mass_change_lock_rows` is True, the rows of each batch are
+        locked first (see `_lock_batch`), and the primary keys of skipped
+        rows are added to `request.mass_change_locked`.
+        """
+        queryset = self.queryset(request)
+        processed = 0
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        signal_kwargs = {
+            'sender': self.model,
+            'fields': plan.fields,
+            'actions': dict((fieldname, plan.get_action(fieldname, ACTIONS.REPLACE)) for fieldname in plan.fields),
+            'request': request,
+        }
+        if isinstance(object_ids, QuerySet):
+            chunks = bulk.keyset_chunked(object_ids, self.mass_change_batch_size)
+        else:
+            chunks = bulk.chunked(object_ids, self.mass_change_batch_size)
+        metrics = self._get_metrics(request)
+        for chunk in chunks:
+            metrics.add_batch(len(chunk))
+            batch = queryset.filter(pk__in=chunk).order_by('pk')
+            pks = chunk
+            if self.mass_change_lock_rows:
+                with metrics.phase('lock'):
+                    locked = self._lock_batch(batch)
+                if locked:
+                    request.mass_change_locked = getattr(request, 'mass_change_locked', []) + locked
+                    to_python = self.model._meta.pk.to_python
+                    pks = [pk for pk in chunk if to_python(pk) not in locked]
+                    batch = batch.exclude(pk__in=locked)
+            if pks:
+                with metrics.phase('signals'):
+                    pre_mass_change.send(queryset=batch, pks=pks, **signal_kwargs)
+                yield batch, pks
+                with metrics.phase('signals'):
+                    post_mass_change.send(queryset=batch, pks=pks, **signal_kwargs)
+            if self.mass_change_commit_per_batch:
+                with metrics.phase('commit'):
+                    transaction.commit()
+            processed += len(chunk)
+            self._report_progress(request, processed=processed)
+
+    def _lock_batch(self, batch):
+        """
+        Lock the rows of `batch`, in primary key order. Rows locked by another
+        transaction are waited for, unless `mass_change_skip_locked` is True
+        and the database supports NOWAIT: they are then skipped, and their
+        primary keys are returned.
+
+        Django has no SKIP LOCKED, so when the batch can't be locked at once,
+        its rows are locked one by one, each in its own savepoint.
+        """
+        using = batch.db
+        if not (self.mass_change_skip_locked and connections[using].features.has_select_for_update_nowait):
+            list(batch.select_for_update().values_list('pk', flat=True))
+            return []
+        if self._lock_nowait(batch):
+            return []
+        return [pk for pk in batch.values_list('pk', flat=True)
+                if not self._lock_nowait(batch.filter(pk=pk))]
+
+    def _lock_nowait(self, queryset):
+        """
+        Lock the rows of `queryset` if none of them is locked by another
+        transaction, and return True. Return False otherwise.
+        """
+        sid = transaction.savepoint(using=queryset.db)
+        try:
+            list(queryset.select_for_update(nowait=True).values_list('pk', flat=True))
+        except DatabaseError:
+            transaction.savepoint_rollback(sid, using=queryset.db)
+            return False
+        transaction.savepoint_commit(sid, using=queryset.db)
+        return True
+
+    def get_mass_change_metrics(self, request):
+        """
+        Return the MassChangeMetrics recording the mass change run in
+        `request`, or a NoMetrics when no one collects them: metrics are
+        only collected in DEBUG mode, or when they are recorded (see
+        `record_mass_change_metrics`) or received (see
+        `signals.mass_change_metrics`).
+        """
+        if (settings.DEBUG or bulk.has_listeners(mass_change_metrics, self.model)
+                or bulk.is_overridden(type(self), 'record_mass_change_metrics', MassAdmin)):
+            return MassChangeMetrics(connections[self.queryset(request).db])
+        return NoMetrics()
+
+    def _get_metrics(self, request):
+        return getattr(request, 'mass_change_metrics', None) or NoMetrics()
+
+    def record_mass_change_metrics(self, request, metrics):
+        """
+        Hook called with the `metrics` of each mass change run, as a dict
+        (see `MassChangeMetrics.as_dict`), to send them to a metrics
+        pipeline for instance. Does nothing by default.
+        """
+        pass
+
+    def _send_metrics(self, request, metrics):
+        if isinstance(metrics, MassChangeMetrics):
+            metrics = metrics.as_dict()
+            mass_change_metrics.send(sender=self.model, metrics=metrics, request=request)
+            self.record_mass_change_metrics(request, metrics)
+
+    def _report_progress(self, request, **progress):
+        """
+        Report the progress of the mass change to the job it is run for, if
+        any (see `MassChangeJob.set_progress`).
+        """
+        job = getattr(request, 'mass_change_job', None)
+        if job is not None:
+            job.set_progress(**progress)
+
+    def _log_changes(self, request, changes):
+        """
+        Log the changes of objects, given as (object, change message)
+        couples, with a single INSERT unless `log_change` is customized.
+        """
+        with self._get_metrics(request).phase('log'):
+            if bulk.is_overridden(type(self), 'log_change', admin.ModelAdmin):
+                for obj, change_message in changes:
+                    self.log_change(request, obj, change_message)
+            else:
+                bulk.log_changes(request.user.pk, changes)
+
+    def _log_mass_change(self, request, plan, count, token):
+        """
+        Log the whole mass change of `count` objects with a single entry
+        referencing the selection `token` (see `mass_change_log_summary`).
+        """
+        opts = self.model._meta
+        change_message = [_('Changed %s.') % get_text_list(list(plan.fields), _('and'))]
+        for FormSet, prefix in plan.formsets:
+            change_message.append(_('Changed %s.') % force_unicode(FormSet.model._meta.verbose_name_plural))
+        LogEntry.objects.create(
+            user_id=request.user.pk,
+            content_type_id=ContentType.objects.get_for_model(self.model).pk,
+            # Not an object: no link to it in the admin
+            object_id='',
+            object_repr=(_('Mass change of %(count)s %(name)s (selection %(token)s)') % {
+                'count': count, 'name': force_unicode(opts.verbose_name_plural), 'token': token})[:200],
+            action_flag=CHANGE,
+            change_message=' '.join(change_message),
+        )
+
+    def _count_selected(self, object_ids):
+        if isinstance(object_ids, QuerySet):
+            return object_ids.count()
+        return len(object_ids)
+
+    def _mass_change_in_bulk(self, request, plan, object_ids):
+        """
+        Validate submitted values once, then write them on each batch of
+        selected objects with one UPDATE statement (plus one for each field
+        to define only where it is empty, to clamp, or to find and replace
+        in), and a few queries for each many-to-many field (see
+        `bulk.bulk_m2m`).
+        Return the last changed object and a dict giving, for each field to
+        define, the number of objects where it was actually defined.
+        """
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        MULTI_ACTIONS = self.mass_actions_options_form.MULTI_ACTIONS
+        NUMERIC_ACTIONS = self.mass_actions_options_form.NUMERIC_ACTIONS
+        metrics = self._get_metrics(request)
+        form = self._get_values_form(plan)
+        with metrics.phase('validation'):
+            if not form.is_valid():
+                raise Exception('Mass change values are not valid: %s' % form.errors)
+
+        opts = self.model._meta
+        columns = dict((f.name, f) for f in opts.fields + opts.many_to_many)
+        change_message = self.construct_change_message(request, form, plan.inline_formsets)
+        defined = {}
+        obj = None
+        send_signals = not self._suppress_row_signals()
+        # When all fields are simply replaced, objects already holding the
+        # new values are left untouched
+        skip_up_to_date = not plan.inline_formsets and all(
+            plan.get_action(fieldname) in (None, ACTIONS.REPLACE)
+            and not isinstance(columns[fieldname], models.ManyToManyField)
+            for fieldname in form.fields)
+        changed_count = 0
+        selected_count = 0
+        for objects, pks in self._iter_batches(request, object_ids, plan):
+            selected_count += len(pks)
+            values = {}
+            # Objects changed by writes depending on their current values
+            matched = set()
+
+            def match(queryset):
+                if not self.mass_change_log_summary:
+                    matched.update(queryset.values_list('pk', flat=True))
+            with metrics.phase('update'):
+                for fieldname in form.fields:
+                    field = columns[fieldname]
+                    value = form.cleaned_data[fieldname]
+                    action = plan.get_action(fieldname)
+                    if isinstance(field, models.ManyToManyField):
+                        if action == MULTI_ACTIONS.REMOVE:
+                            matched |= bulk.bulk_m2m_remove(objects, field, value, send_signals=send_signals)
+                            continue
+                        changed = bulk.bulk_m2m(objects, field, value,
+                                                only_empty=action == MULTI_ACTIONS.DEFINE,
+                                                replace=action == MULTI_ACTIONS.REPLACE, send_signals=send_signals)
+                        matched |= changed
+                        if action == MULTI_ACTIONS.DEFINE:
+                            defined[fieldname] = defined.get(fieldname, 0) + len(changed)
+                    elif isinstance(field, NUMERIC_FIELDS):
+                        if action in (NUMERIC_ACTIONS.MIN, NUMERIC_ACTIONS.MAX):
+                            lookup = action == NUMERIC_ACTIONS.MIN and 'lt' or 'gt'
+                            clamped = objects.filter(**{'%s__%s' % (fieldname, lookup): value})
+                            match(clamped)
+                            bulk.bulk_update(clamped, {fieldname: value})
+                        elif action == NUMERIC_ACTIONS.ADD:
+                            values[fieldname] = F(fieldname) + value
+                        elif action == NUMERIC_ACTIONS.SUBTRACT:
+                            values[fieldname] = F(fieldname) - value
+                        elif action == NUMERIC_ACTIONS.MULTIPLY:
+                            values[fieldname] = F(fieldname) * value
+                        else:
+                            values[fieldname] = value
+                    elif action == ACTIONS.DEFINE:
+                        match(objects.filter(bulk.empty_q(fieldname)))
+                        defined[fieldname] = defined.get(fieldname, 0) + bulk.bulk_define(objects, fieldname, value)
+                    elif action == ACTIONS.FIND_REPLACE:
+                        find, regex = plan.find_options[fieldname]
+                        match(bulk.filter_matching(objects, field, find, regex))
+                        bulk.bulk_find_replace(objects, field, find, value, regex=regex)
+                    elif action in (ACTIONS.PREPEND, ACTIONS.APPEND):
+                        if field.max_length is not None:
+                            too_long = bulk.count_too_long(objects, field, extra_length=len(value))
+                            if too_long:
+                                raise Exception('Field %s would exceed its maximum length (%s) on %s of the selected objects.' % (fieldname, field.max_length, too_long))
+                        if action == ACTIONS.PREPEND:
+                            values[fieldname] = Concat(value, F(fieldname))
+                        else:
+                            values[fieldname] = Concat(F(fieldname), value)
+                    else:
+                        values[fieldname] = value
+            self._create_inline_objects(request, plan, objects)
+
+            with metrics.phase('update'):
+                if values and skip_up_to_date:
+                    changed_pks = list(objects.exclude(**values).values_list('pk', flat=True))
+                    changed_count += len(changed_pks)
+                    objects = objects.filter(pk__in=changed_pks)
+                    if changed_pks:
+                        bulk.bulk_update(objects, values)
+                elif values:
+                    bulk.bulk_update(objects, values)
+
+            if not self.mass_change_log_summary:
+                if not (values or plan.inline_formsets):
+                    # Only objects matched by the writes were changed
+                    objects = objects.filter(pk__in=matched)
+                self._log_changes(request, ((obj, change_message) for obj in plan.get_objects(objects, prefetch=False).iterator()))
+        counts = None
+        if skip_up_to_date:
+            # Counted batch by batch, as changed objects may not match the
+            # changelist filters anymore
+            counts = (changed_count, selected_count - changed_count)
+        return obj, defined, counts
+
+    def _get_values_form(self, plan):
+        """
+        Return the form validating the submitted values of `plan` once for
+        all objects, values that are only a part of new values being
+        optional.
+        """
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        form = plan.form_class(plan.data, plan.files)
+        for fieldname in plan.exclude_fields:
+            del form.fields[fieldname]
+        for fieldname, action in plan.actions:
+            if action in (ACTIONS.PREPEND, ACTIONS.APPEND, ACTIONS.FIND_REPLACE):
+                # Submitted value is only a part of the new value
+                form.fields[fieldname].required = False
+        return form
+
+    def get_mass_change_plan(self, request, ModelForm, dry_run=False):
+        """
+        Compile the mass change submitted in `request` with `ModelForm` into
+        a MassChangePlan, once for all the selected objects.
+        If `dry_run` is True, uploaded files are not stored.
+        """
+        # Store which fields are handled on this mass change.
+        # Also, store optionnal mass actions (replace, preprend,
+        # append, etc.) on those fields.
+        # FIXME: doing this on ModelForm *class*'s base_fields saves us
+        # from doing it for each form, but on the other hand,
+        # form.__init__ could change some fields or widget at instanciation
+        # time... We should move back this work inside looping of each form,
+        # but trying to do it only once...
+        exclude_fields = []
+        special_handled_fields = {}  # format -- {'<field name>': '<action>'}
+        for fieldname, field in ModelForm.base_fields.items():
+            mass_options_form = self.mass_actions_options_form(data=request.POST, field=field, field_name=fieldname)
+            if mass_options_form.is_valid():
+                mass_field_name = mass_options_form.get_mass_field_name()
+                handle_mass_change = mass_options_form.cleaned_data.get(mass_field_name, False)
+                if handle_mass_change:
+                    action = mass_options_form.cleaned_data.get(mass_field_name + '_action', None)
+                    if action:
+                        special_handled_fields[fieldname] = action
+                else:
+                    exclude_fields.append(fieldname)
+            else:
+                raise Exception('Mass options for field %s are not valid: %s ' % (fieldname, mass_options_form.errors))
+
+        # Values and options that are the same for each object. Custom forms
+        # may narrow the querysets or choices of their fields in __init__:
+        # their values are then cleaned by each form.
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        cleaned_values = {}
+        # File fields whose upload is stored once for all objects
+        uploads = []
+        preclean = not bulk.is_overridden(ModelForm, '__init__', BaseModelForm)
+        for fieldname, field in ModelForm.base_fields.items():
+            if fieldname in exclude_fields or not preclean:
+                continue
+            if isinstance(field, forms.FileField):
+                if not self.mass_change_copy_files and not dry_run and fieldname in request.FILES:
+                    uploads.append((fieldname, field))
+                continue
+            if special_handled_fields.get(fieldname, ACTIONS.REPLACE) != ACTIONS.REPLACE:
+                # The new value depends on each object
+                continue
+            try:
+                cleaned_values[fieldname] = field.clean(field.widget.value_from_datadict(request.POST, request.FILES, fieldname))
+            except ValidationError:
+                continue  # Let the form report the error
+            if isinstance(cleaned_values[fieldname], QuerySet):
+                # Fetch chosen objects once for all
+                len(cleaned_values[fieldname])
+        find_options = {}
+        operands = {}
+        for fieldname, action in special_handled_fields.items():
+            field = ModelForm.base_fields[fieldname]
+            if action == ACTIONS.FIND_REPLACE:
+                find_options[fieldname] = self._get_find_options(request.POST, fieldname, field)
+            elif isinstance(field, NUMERIC_FORM_FIELDS):
+                try:
+                    operands[fieldname] = field.clean(field.widget.value_from_datadict(request.POST, request.FILES, fieldname))
+                except ValidationError:
+                    operands[fieldname] = None  # Let the form report the error
+
+        formsets = [(FormSet, prefix) for FormSet, prefix in self._get_formsets_with_prefixes(request)
+                    if self._is_inline_selected(request, prefix)]
+        inline_formsets = []
+        if formsets and all(self._can_mass_change_inline_in_bulk(FormSet) for FormSet, prefix in formsets):
+            inline_formsets = [FormSet(request.POST, request.FILES, instance=self.model(), prefix=prefix)
+                               for FormSet, prefix in formsets]
+            if not all_valid(inline_formsets):
+                raise Exception('Mass change inlines are not valid: %s' % [formset.errors for formset in inline_formsets])
+            for formset in inline_formsets:
+                # Only fills formset.new_objects
+                formset.save(commit=False)
+            formsets = []
+
+        compile_plan = partial(MassChangePlan.compile, ModelForm, exclude_fields, special_handled_fields, cleaned_values,
+                               select_related=self.mass_change_select_related,
+                               find_options=find_options, operands=operands, formsets=tuple(formsets),
+                               inline_formsets=inline_formsets, data=request.POST, files=request.FILES)
+        if uploads and self._get_values_form(compile_plan()).is_valid():
+            # Files are only stored once the other values are valid
+            for fieldname, field in uploads:
+                stored = self._store_mass_change_file(request, fieldname, field)
+                if stored is not None:
+                    cleaned_values[fieldname] = stored
+        return compile_plan()
+
+    def _can_mass_change_inline_in_bulk(self, FormSet):
+        """
+        Return True if the new objects of inline `FormSet` can be validated
+        once and created for all changed objects with `bulk_create`, i.e.
+        if `mass_change_bulk_inlines` is True and nothing specific happens
+        when saving them (no custom save methods, no many-to-many fields, no
+        pre_save/post_save receivers).
+
+        Inline models with unique constraints (other than their primary key)
+        are not, as new objects are validated with a blank parent, which
+        skips uniqueness checks involving it.
+        """
+        if not self.mass_change_bulk_inlines or not hasattr(FormSet, 'fk'):
+            return False
+        model = FormSet.model
+        opts = model._meta
+        if opts.unique_together or any(field.unique and not field.primary_key for field in opts.fields):
+            return False
+        if opts.parents or any(isinstance(field, forms.ModelMultipleChoiceField)
+                                      for field in FormSet.form.base_fields.values()):
+            return False
+        return not (bulk.is_overridden(type(self), 'save_formset', admin.ModelAdmin)
+                    or bulk.is_overridden(FormSet.form, 'save', BaseModelForm)
+                    or bulk.is_overridden(model, 'save', models.Model)
+                    or bulk.has_listeners(signals.pre_save, model)
+                    or bulk.has_listeners(signals.post_save, model))
+
+    def _create_inline_objects(self, request, plan, objects):
+        """
+        Create the new inline objects of `plan` for each of `objects`, a
+        batch of changed objects.
+        """
+        with self._get_metrics(request).phase('inlines'):
+            for formset in plan.inline_formsets:
+                bulk.bulk_create_related(objects, formset.fk, formset.new_objects)
+
+    def _store_mass_change_file(self, request, fieldname, formfield):
+        """
+        Save the file uploaded in `request` for file field `fieldname`
+        once, with the storage of the model field, and return its name, to
+        be assigned to every changed object.
+        Return None if the upload is not valid (the form reports the error)
+        or if the field is not a model file field.
+
+        Stored files are listed in `request.mass_change_stored_files`, to be
+        deleted if the mass change fails (see `_mass_change`).
+        """
+        field = dict((f.name, f) for f in self.model._meta.fields).get(fieldname)
+        if not isinstance(field, models.FileField):
+            return None
+        try:
+            upload = formfield.clean(formfield.widget.value_from_datadict(request.POST, request.FILES, fieldname), None)
+        except ValidationError:
+            return None
+        # The name is generated for a blank object, that upload_to callables
+        # get as instance.
+        name = field.storage.save(field.generate_filename(self.model(), upload.name), upload)
+        request.mass_change_stored_files = getattr(request, 'mass_change_stored_files', []) + [(field.storage, name)]
+        return name
+
+    def _mass_change(self, request, ModelForm, object_ids, token=None):
+        """
+        Apply the mass change submitted in `request` on the selected
+        objects, in bulk when possible (see `_can_mass_change_in_bulk`),
+        else by saving each object through its own form.
+        Return the last changed object, in bulk, a dict giving the number
+        of objects where fields to define were actually defined, and, if
+        known, the number of changed and untouched objects (objects whose
+        form has no changes are not saved).
+        `token` is the selection of these objects, for the log.
+
+        Metrics of the run are collected on the way, if needed (see
+        `get_mass_change_metrics`).
+
+        Transactions are left to the caller, which rolls back the change if
+        it fails: files stored for it are then deleted, unless some batches
+        may have been committed (see `mass_change_commit_per_batch`).
+        """
+        metrics = request.mass_change_metrics = self.get_mass_change_metrics(request)
+        request.mass_change_stored_files = []
+        try:
+            with metrics.running():
+                with metrics.phase('plan'):
+                    plan = self.get_mass_change_plan(request, ModelForm)
+                if self.mass_change_log_summary:
+                    with metrics.phase('log'):
+                        self._log_mass_change(request, plan, self._count_selected(object_ids), token)
+                if self._can_mass_change_in_bulk(request, plan):
+                    result = self._mass_change_in_bulk(request, plan, object_ids)
+                else:
+                    result = self._mass_change_by_object(request, plan, object_ids)
+                if result[2] is not None:
+                    metrics.set_counts(*result[2])
+        except Exception:
+            exc_info = sys.exc_info()
+            if not self.mass_change_commit_per_batch:
+                for storage, name in request.mass_change_stored_files:
+                    storage.delete(name)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self._send_metrics(request, metrics)
+        return result
+
+    def _mass_change_by_object(self, request, plan, object_ids):
+        """
+        Apply the mass change compiled in `plan` by saving each selected
+        object through its own form (and inline formsets).
+        Return the last changed object, None, and the number of changed and
+        untouched objects.
+        """
+        metrics = self._get_metrics(request)
+        new_object = None
+        objects_count = 0
+        changed_count = 0
+        untouched_count = 0
+
+        for objects, pks in self._iter_batches(request, object_ids, plan):
+            changes = []
+            change_messages = {}
+            # Only one batch of objects is loaded at once, along with the
+            # relations the plan needs
+            with metrics.phase('fetch'):
+                objects_list = list(plan.get_objects(objects))
+            for obj in objects_list:
+                objects_count += 1
+                with metrics.phase('validation'):
+                    form = plan.get_form(obj)
+
+                    # If there are some fields that need special action
+                    # (prepend, append, etc.), alter the form data accordingly
+                    # *before* calling ModelForm.is_valid() (which is
+                    # responsible for *using* and cleaning POST data).
+                    for fieldname, action in plan.actions:
+                        self._handle_field_action(fieldname, action, form, obj, plan)
+
+                    if form.is_valid():
+                        form_validated = True
+                        new_object = self.save_form(request, form, change=True)
+                    else:
+                        form_validated = False
+                        new_object = obj
+
+                with metrics.phase('inlines'):
+                    formsets = plan.get_formsets(new_object)
+                    formsets_validated = all_valid(formsets)
+
+                if form_validated and not formsets and not plan.inline_formsets and not form.changed_data:
+                    # Already up to date
+                    untouched_count += 1
+                    continue
+
+                if formsets_validated and form_validated:
+                    with metrics.phase('save'):
+                        if plan.update_fields and not bulk.is_overridden(type(self), 'save_model', admin.ModelAdmin):
+                            bulk.save_fields(new_object, plan.update_fields)
+                        else:
+                            self.save_model(request, new_object, form, change=True)
+                    with metrics.phase('save_m2m'):
+                        form.save_m2m()
+                    with metrics.phase('inlines'):
+                        for formset in formsets:
+                            self.save_formset(request, form, formset, change=True)
+
+                    if formsets:
+                        change_message = self.construct_change_message(request, form, formsets)
+                    else:
+                        # Same message for objects where the same fields changed
+                        changed_data = tuple(form.changed_data)
+                        if changed_data not in change_messages:
+                            change_messages[changed_data] = self.construct_change_message(request, form, plan.inline_formsets)
+                        change_message = change_messages[changed_data]
+                    changes.append((new_object, change_message))
+                    changed_count += 1
+
+            if changed_count + untouched_count != objects_count:
+                self._report_progress(request, failed=objects_count - changed_count - untouched_count)
+                raise Exception('Some of the selected objects could\'t be changed.')
+            self._create_inline_objects(request, plan, objects)
+            if not self.mass_change_log_summary:
+                self._log_changes(request, changes)
+        return new_object, None, (changed_count, untouched_count)
+
+    def get_mass_change_preview(self, request, plan, object_ids):
+        """
+        Return what the mass change compiled in `plan` would do on the
+        selected objects, without changing them, as a dict holding:
+          - `total`: the number of selected objects,
+          - `fields`: for each mass changed field, a dict giving its `label`,
+            its `action`, the number of objects it would `change` or leave
+            `unchanged`, and the number of objects where its new value would
+            be `too_long` (None when they can't be counted in the database),
+          - `samples`: (object, [(label, current value, new value), ...])
+            couples for the first `mass_change_preview_samples` objects,
+          - `errors`: errors of the submitted values, if they are not valid.
+
+        Counts are computed with a single aggregate query per batch of
+        objects (see `bulk.count_matching`), new values of samples by their
+        forms.
+        """
+        ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
+        NUMERIC_ACTIONS = self.mass_actions_options_form.NUMERIC_ACTIONS
+        action_labels = dict(self.mass_actions_options_form.MULTI_ACTIONS.CHOICES
+                             + NUMERIC_ACTIONS.CHOICES + ACTIONS.CHOICES)
+        opts = self.model._meta
+        columns = dict((f.name, f) for f in opts.fields + opts.many_to_many)
+        queryset = self.queryset(request)
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        preview = {'total': self._count_selected(object_ids), 'fields': [], 'samples': [], 'errors': None}
+
+        form = self._get_values_form(plan)
+        if not form.is_valid():
+            preview['errors'] = form.errors
+            return preview
+
+        # Conditions matching objects changed by each field, and objects
+        # where it would be too long, by (field name, count name)
+        conditions = SortedDict()
+        for fieldname in form.fields:
+            field = columns.get(fieldname)
+            action = plan.get_action(fieldname, ACTIONS.REPLACE)
+            value = form.cleaned_data[fieldname]
+            preview['fields'].append({
+                'name': fieldname,
+                'label': capfirst(force_unicode(field is not None and field.verbose_name or form.fields[fieldname].label or fieldname)),
+                'action': action_labels.get(action, action),
+                'changed': None,
+                'unchanged': None,
+                'too_long': None,
+            })
+            if field is None or isinstance(field, (models.ManyToManyField, models.FileField)):
+                continue
+            column = '%s.%s' % (qn(opts.db_table), qn(field.column))
+            changed = None
+            if action == ACTIONS.DEFINE:
+                changed = Q(**{'%s__isnull' % fieldname: True}) | Q(**{fieldname: ''})
+            elif action in (ACTIONS.PREPEND, ACTIONS.APPEND):
+                changed = bool(value)
+                if value and field.max_length is not None:
+                    conditions[fieldname, 'too_long'] = ('%s > %%s' % length_sql(connection, column), [field.max_length - len(value)])
+            elif action == ACTIONS.FIND_REPLACE:
+                find, regex = plan.find_options[fieldname]
+                changed = bulk.matching_condition(queryset, field, find, regex)
+                replace = replace_sql(connection, column, regex)
+                if field.max_length is not None and replace is not None:
+                    conditions[fieldname, 'too_long'] = ('%s > %%s' % length_sql(connection, replace), [find, value or '', field.max_length])
+            elif action == NUMERIC_ACTIONS.MIN:
+                changed = Q(**{'%s__lt' % fieldname: value})
+            elif action == NUMERIC_ACTIONS.MAX:
+                changed = Q(**{'%s__gt' % fieldname: value})
+            elif action in (NUMERIC_ACTIONS.ADD, NUMERIC_ACTIONS.SUBTRACT):
+                changed = bool(value)
+            elif action == NUMERIC_ACTIONS.MULTIPLY:
+                changed = value != 1
+            else:
+                changed = ~Q(**{fieldname: value})
+            if isinstance(changed, bool):
+                # Every object, or none
+                preview['fields'][-1]['changed'] = changed and preview['total'] or 0
+            else:
+                conditions[fieldname, 'changed'] = changed
+
+        if conditions:
+            counts = dict.fromkeys(conditions, 0)
+            if isinstance(object_ids, QuerySet):
+                batches = [object_ids]
+            else:
+                batches = (queryset.filter(pk__in=chunk) for chunk in bulk.chunked(object_ids, self.mass_change_batch_size))
+            for objects in batches:
+                for key, count in zip(conditions, bulk.count_matching(objects, conditions.values())[1:]):
+                    counts[key] += count
+            for field_preview in preview['fields']:
+                for name in ('changed', 'too_long'):
+                    if (field_preview['name'], name) in counts:
+                        field_preview[name] = counts[field_preview['name'], name]
+        for field_preview in preview['fields']:
+            if field_preview['changed'] is not None:
+                field_preview['unchanged'] = preview['total'] - field_preview['changed']
+
+        # New values of a few objects
+        if isinstance(object_ids, QuerySet):
+            sample_ids = list(object_ids.order_by('pk').values_list('pk', flat=True)[:self.mass_change_preview_samples])
+        else:
+            sample_ids = sorted(object_ids)[:self.mass_change_preview_samples]
+        fields = [columns[fieldname] for fieldname in form.fields
+                  if fieldname in columns and not isinstance(columns[fieldname], models.ManyToManyField)]
+        for obj in plan.get_objects(queryset.filter(pk__in=sample_ids).order_by('pk')):
+            sample = force_unicode(obj)
+            before = [display_for_field(getattr(obj, field.name), field) for field in fields]
+            obj_form = plan.get_form(obj)
+            for fieldname, action in plan.actions:
+                self._handle_field_action(fieldname, action, obj_form, obj, plan)
+            if obj_form.is_valid():
+                # Only changes obj in memory
+                obj_form.save(commit=False)
+                after = [display_for_field(getattr(obj, field.name), field) for field in fields]
+            else:
+                after = [u' '.join(obj_form.errors.get(field.name, [])) for field in fields]
+            preview['samples'].append((sample, zip([capfirst(force_unicode(field.verbose_name)) for field in fields],
+                                                   before, after)))
+        return preview
+
+    def _should_run_as_job(self, request, object_ids):
+        """
+        Return True if the mass change should be run by a MassChangeJob
+        instead of in the current request.
+        """
+        if self.mass_change_job_threshold is None or request.FILES:
+            # Uploaded files only live as long as the request
+            return False
+        return self._count_selected(object_ids) >= self.mass_change_job_threshold
+
+    def run_mass_change_job(self, job):
+        """
+        Apply the mass change saved in `job`, as its user, and record its
+        outcome. Return False if another worker is already running it.
+        """
+        request = HttpRequest()
+        request.method = 'POST'
+        request.user = job.user
+        request.POST = QueryDict(job.data)
+        request.FILES = MultiValueDict()
+        request.session = {}
+        request.mass_change_job = job
+        if job.query_string is not None:
+            object_ids = self.get_changelist_queryset(request, job.query_string)
+        else:
+            object_ids = selection.decode_pks(self.model, job.object_ids)
+
+        if not job.start():
+            return False
+        error = counts = None
+        with transaction.commit_manually():
+            try:
+                new_object, defined, counts = self._mass_change(request, self.get_mass_form(request), object_ids, job.token)
+                transaction.commit()
+            except Exception:
+                error = unicode(sys.exc_info()[1])
+                transaction.rollback()
+        job.finish(error, counts)
+        return True
+
+    def _get_job(self, request, job_id):
+        """
+        Return the mass change job `job_id` of the user, on this model.
+        """
+        if not self.has_change_permission(request, None):
+            raise PermissionDenied
+        job = get_object_or_404(MassChangeJob, pk=job_id, user=request.user)
+        if job.content_type.model_class() is not self.model:
+            raise Http404
+        return job
+
+    def mass_change_job_view(self, request, job_id):
+        """
+        Return the progress of a mass change job, as JSON.
+        """
+        job = self._get_job(request, job_id)
+        return HttpResponse(simplejson.dumps(job.get_progress()), content_type='application/json')
+
+    def mass_change_job_status_view(self, request, job_id):
+        """
+        The page following the progress of a mass change job.
+        """
+        return self.response_mass_change_job(request, self._get_job(request, job_id))
+
+    def _is_large_relation(self, db_field, threshold, using=None):
+        """
+        Return True if `db_field` relates to more than `threshold` objects.
+        This is cached for `mass_change_cache_timeout` seconds.
+        """
+        opts = db_field.rel.to._meta
+        key = 'massadmin-large-%s-%s-%s' % (opts.app_label, opts.module_name, threshold)
+        is_large = cache.get(key)
+        if is_large is None:
+            queryset = db_field.rel.to._default_manager.using(using)
+            is_large = queryset.all()[:threshold + 1].count() > threshold
+            if self.mass_change_cache_timeout:
+                cache.set(key, is_large, self.mass_change_cache_timeout)
+        return is_large
+
+    def _get_mass_change_metadata(self):
+        """
+        Return a dict of what the mass change form needs to know about the
+        fields of the model: names of unique fields and the signature of all
+        fields, computed once.
+        """
+        if getattr(self, '_mass_change_metadata', None) is None:
+            opts = self.model._meta
+            fields = opts.fields + opts.many_to_many
+            self._mass_change_metadata = {
+                'unique_fields': [field.name for field in fields if field.unique],
+                'signature': [(field.name, field.__class__.__name__, field.unique, force_unicode(field.verbose_name))
+                              for field in fields],
+            }
+        return self._mass_change_metadata
+
+    def get_mass_change_cache_key(self, request, adminForm):
+        """
+        Return the key of the cached fieldsets of the mass change form
+        `adminForm`, or None if they can't be cached, which is the case
+        unless only their checkboxes are rendered (see
+        `mass_change_lazy_widgets`).
+
+        The key depends on the fields of the model, the fieldsets, the read
+        only fields, the permissions of the user and the language. Override
+        this method if the form depends on anything else in `request`.
+        """
+        if not self.mass_change_lazy_widgets or not self.mass_change_cache_timeout:
+            return None
+        fieldsets = [(force_unicode(name or ''), force_unicode(options.get('description') or ''),
+                      tuple(options.get('classes', ())), repr(options['fields']))
+                     for name, options in adminForm.fieldsets]
+        signature = (
+            self._get_mass_change_metadata()['signature'], fieldsets, list(adminForm.readonly_fields),
+            self.has_add_permission(request), self.has_change_permission(request),
+            self.has_delete_permission(request), get_language(), _PROCESS_TOKEN,
+        )
+        return hashlib.md5(repr(signature)).hexdigest()
+
+    def mass_change_field_view(self, request, field_name):
+        """
+        Render the widget and the mass change options of a field of the mass
+        change form, when its checkbox is checked in a form rendering the
+        checkboxes only (see `mass_change_lazy_widgets`).
+        """
+        if not self.has_change_permission(request, None):
+            raise PermissionDenied
+        form = self.get_mass_form(request)()
+        if field_name not in form.fields:
+            raise Http404
+        context = {
+            'field': form[field_name],
+            'mass_actions_options_form': self.mass_actions_options_form,
+        }
+        context_instance = template.RequestContext(request, current_app=self.admin_site.name)
+        return render_to_response('massadmin/mass_change_field.html', context, context_instance=context_instance)
+
+    def mass_change_view(self, request, token=None, extra_context=None):
         """The 'mass change' admin view for this model."""
         model = self.model
         opts = model._meta
         general_error = None
 
-        object_ids = object_ids.split(',')
-
         if not self.has_change_permission(request, None):  # FIXME: use a specific permission for mass_change
             raise PermissionDenied
 
+        selected = selection.load_selection(request, model, token)
+        if selected is None:
+            self.message_user(request, _('This selection has expired, please select objects to change again.'))
+            info = opts.app_label, opts.module_name
+            return HttpResponseRedirect(reverse('admin:%s_%s_changelist' % info, current_app=self.admin_site.name))
+        object_ids, query_string = selected
+        if query_string is not None:
+            # Objects matching the changelist filters now, not when they were
+            # selected.
+            object_ids = self.get_changelist_queryset(request, query_string)
+
         ModelForm = self.get_mass_form(request)
         formsets = []
-        if request.method == 'POST':
+        if request.method == 'POST' and '_preview' in request.POST:
+            plan = self.get_mass_change_plan(request, ModelForm, dry_run=True)
+            return self.response_mass_change_preview(request, self.get_mass_change_preview(request, plan, object_ids))
 
-            # Store which fields are handled on this mass change.
-            # Also, store optionnal mass actions (replace, preprend,
-            # append, etc.) on those fields.
-            # FIXME: doing this on ModelForm *class*'s base_fields saves us
-            # from doing it for each form, but on the other hand,
-            # form.__init__ could change some fields or widget at instanciation
-            # time... We should move back this work inside looping of each form,
-            # but trying to do it only once...
-            exclude_fields = []
-            special_handled_fields = {}  # format -- {'<field name>': '<action>'}
-            for fieldname, field in ModelForm.base_fields.items():
-                mass_options_form = self.mass_actions_options_form(data=request.POST, field=field, field_name=fieldname)
-                if mass_options_form.is_valid():
-                    mass_field_name = mass_options_form.get_mass_field_name()
-                    handle_mass_change = mass_options_form.cleaned_data.get(mass_field_name, False)
-                    if handle_mass_change:
-                        action = mass_options_form.cleaned_data.get(mass_field_name + '_action', None)
-                        if action:
-                            special_handled_fields[fieldname] = action
-                    else:
-                        exclude_fields.append(fieldname)
-                else:
-                    raise Exception('Mass options for field %s are not valid: %s ' % (fieldname, mass_options_form.errors))
+        if request.method == 'POST':
+            if self._should_run_as_job(request, object_ids):
+                # The worker has its own connection: the job must be
+                # committed before it is run
+                with transaction.commit_on_success():
+                    job = MassChangeJob.create(request, model, token, object_ids, query_string)
+                if self.mass_change_jobs_in_thread:
+                    jobs.enqueue(job, self)
+                info = opts.app_label, opts.module_name
+                return HttpResponseRedirect(reverse('admin:%s_%s_massadmin_job_status' % info, args=(job.pk,),
+                                                    current_app=self.admin_site.name))
 
             # commit only when all forms are valid
             with transaction.commit_manually():
                 try:
-                    objects_count = 0
-                    changed_count = 0
-
-                    objects = self.queryset(request).filter(pk__in=object_ids)
-                    for obj in objects:
-                        objects_count += 1
-                        form = ModelForm(request.POST, request.FILES, instance=obj)
-
-                        for fieldname in exclude_fields:
-                            del form.fields[fieldname]
-
-                        if special_handled_fields:
-                            # If there are some fields that need special
-                            # action (prepend, append, etc.), make a deepcopy
-                            # of POST data and alter it accordingly *before*
-                            # calling ModelForm.is_valid() (which is
-                            # responsible for *using* and cleaning POST data).
-                            form.data = deepcopy(form.data)
-                            for fieldname, action in special_handled_fields.items():
-                                self._handle_field_action(fieldname, action, form, obj)
-
-                        if form.is_valid():
-                            form_validated = True
-                            new_object = self.save_form(request, form, change=True)
-                        else:
-                            form_validated = False
-                            new_object = obj
-
-                        prefixes = {}
-                        for FormSet in self.get_formsets(request, new_object):
-                            prefix = FormSet.get_default_prefix()
-                            prefixes[prefix] = prefixes.get(prefix, 0) + 1
-                            if prefixes[prefix] != 1:
-                                prefix = "%s-%s" % (prefix, prefixes[prefix])
-
-                            # Check if inline formset has been selected for
-                            # mass change. If it is the case, store it
-                            # for later use
-                            mass_options_form = self.mass_actions_options_form(data=request.POST, field_name=prefix)
-                            if mass_options_form.is_valid():
-                                mass_field_name = mass_options_form.get_mass_field_name()
-                                handle_mass_change = mass_options_form.cleaned_data.get(mass_field_name, False)
-                                if handle_mass_change:
-                                    formset = FormSet(request.POST, request.FILES, instance=new_object, prefix=prefix)
-                                    formsets.append(formset)
-                            else:
-                                raise Exception('Mass options for inline %s are not valid: %s' % (prefix, mass_options_form.errors))
-
-                        if all_valid(formsets) and form_validated:
-                            self.save_model(request, new_object, form, change=True)
-                            form.save_m2m()
-                            for formset in formsets:
-                                self.save_formset(request, form, formset, change=True)
-
-                            change_message = self.construct_change_message(request, form, formsets)
-                            self.log_change(request, new_object, change_message)
-                            changed_count += 1
-
-                    if changed_count != objects_count:
-                        raise Exception('Some of the selected objects could\'t be changed.')
+                    new_object, defined, counts = self._mass_change(request, ModelForm, object_ids, token)
                     transaction.commit()
-                    return self.response_mass_change(request, new_object)
+                    return self.response_mass_change(request, new_object, defined=defined, counts=counts)
 
                 finally:
                     general_error = unicode(sys.exc_info()[1])
                     transaction.rollback()
 
         form = ModelForm()
-        prefixes = {}
-        for FormSet in self.get_formsets(request):
-            prefix = FormSet.get_default_prefix()
-            prefixes[prefix] = prefixes.get(prefix, 0) + 1
-            if prefixes[prefix] != 1:
-                prefix = "%s-%s" % (prefix, prefixes[prefix])
+        for FormSet, prefix in self._get_formsets_with_prefixes(request):
             formset = FormSet(prefix=prefix)
             formsets.append(formset)
 
@@ -239,14 +1351,7 @@ class MassAdmin(admin.ModelAdmin):
         media = self.media + adminForm.media
 
         # We don't want the user trying to mass change unique fields!
-        unique_fields = []
-        for field_name in model._meta.get_all_field_names():
-            try:
-                field = model._meta.get_field(field_name)
-                if field.unique:
-                    unique_fields.append(field_name)
-            except:
-                pass
+        unique_fields = self._get_mass_change_metadata()['unique_fields']
 
         inline_admin_formsets = []
 
@@ -257,7 +1362,7 @@ class MassAdmin(admin.ModelAdmin):
             inline_admin_formsets.append(inline_admin_formset)
             media = media + inline_admin_formset.media
 
-        n_objects = len(object_ids)
+        n_objects = self._count_selected(object_ids)
         context = {
             'title': _('Mass change of %(n_objects)s %(verbose_name)s%(plural)s') % {'n_objects': n_objects, 'verbose_name': force_unicode(opts.verbose_name), 'plural': pluralize(n_objects)},
             'adminform': adminForm,
@@ -268,15 +1373,22 @@ class MassAdmin(admin.ModelAdmin):
             'errors': helpers.AdminErrorList(form, formsets),
             'general_error': general_error,
             'app_label': opts.app_label,
-            'object_ids': ",".join(object_ids),
+            'selection_token': token,
             'mass_actions_options_form': self.mass_actions_options_form,
+            'lazy_widgets': self.mass_change_lazy_widgets,
+            # Errors are displayed in fieldsets
+            'fieldsets_cache_key': not general_error and self.get_mass_change_cache_key(request, adminForm) or None,
+            'fieldsets_cache_timeout': self.mass_change_cache_timeout,
         }
         context.update(extra_context or {})
         return self.render_mass_change_form(request, context)
 
-    def _handle_field_action(self, fieldname, action, form, obj):
+    def _handle_field_action(self, fieldname, action, form, obj, plan):
         """
         Transform the form for the field accordingly to the action.
+
+        Lists of values of the form data are shared between objects (see
+        `MassChangePlan.get_form`): they must be replaced, not altered.
         """
         if isinstance(obj._meta.get_field_by_name(fieldname)[0], models.ManyToManyField):
             ACTIONS = self.mass_actions_options_form.MULTI_ACTIONS
@@ -286,6 +1398,12 @@ class MassAdmin(admin.ModelAdmin):
                 self._handle_action_define_m2m(fieldname, action, form, obj)
             elif action == ACTIONS.REPLACE:
                 self._handle_action_replace_m2m(fieldname, action, form, obj)
+            elif action == ACTIONS.REMOVE:
+                self._handle_action_remove_m2m(fieldname, action, form, obj)
+        elif isinstance(form.fields[fieldname], NUMERIC_FORM_FIELDS):
+            ACTIONS = self.mass_actions_options_form.NUMERIC_ACTIONS
+            if action != ACTIONS.REPLACE:
+                self._handle_action_numeric(fieldname, action, form, obj, plan.operands[fieldname])
         else:
             ACTIONS = self.mass_actions_options_form.CHARFIELD_ACTIONS
             if action == ACTIONS.PREPEND:
@@ -296,12 +1414,14 @@ class MassAdmin(admin.ModelAdmin):
                 self._handle_action_define(fieldname, action, form, obj)
             elif action == ACTIONS.REPLACE:
                 self._handle_action_replace(fieldname, action, form, obj)
+            elif action == ACTIONS.FIND_REPLACE:
+                self._handle_action_find_replace(fieldname, action, form, obj, plan.find_options[fieldname])
 
     def _handle_action_prepend(self, fieldname, action, form, obj):
-        form.data[fieldname] = form.data[fieldname] + getattr(obj, fieldname, '')
+        form.data[fieldname] = form.data[fieldname] + (getattr(obj, fieldname, None) or '')
 
     def _handle_action_append(self, fieldname, action, form, obj):
-        form.data[fieldname] = getattr(obj, fieldname, '') + form.data[fieldname]
+        form.data[fieldname] = (getattr(obj, fieldname, None) or '') + form.data[fieldname]
 
     def _handle_action_define(self, fieldname, action, form, obj):
         if getattr(obj, fieldname, ''):
@@ -312,11 +1432,55 @@ class MassAdmin(admin.ModelAdmin):
     def _handle_action_replace(self, fieldname, action, form, obj):
         pass  # replace is the default action
 
+    def _get_find_options(self, data, fieldname, field):
+        """
+        Return the text to find of 'find and replace' action on `fieldname`,
+        and whether it is a regular expression.
+        """
+        mass_options_form = self.mass_actions_options_form(data=data, field=field, field_name=fieldname)
+        mass_options_form.is_valid()  # Options have already been validated
+        return mass_options_form.get_find_options()
+
+    def _handle_action_find_replace(self, fieldname, action, form, obj, find_options):
+        find, regex = find_options
+        value = getattr(obj, fieldname, None) or ''
+        if regex:
+            form.data[fieldname] = re.sub(find, form.data[fieldname], value)
+        else:
+            form.data[fieldname] = value.replace(find, form.data[fieldname])
+
+    def _handle_action_numeric(self, fieldname, action, form, obj, operand):
+        value = getattr(obj, fieldname)
+        if value is None:
+            # Like in SQL, arithmetic on an empty value stays empty
+            del form.fields[fieldname]
+            return
+        if operand is None:
+            return  # Let the form report the error
+        ACTIONS = self.mass_actions_options_form.NUMERIC_ACTIONS
+        if action == ACTIONS.ADD:
+            value = value + operand
+        elif action == ACTIONS.SUBTRACT:
+            value = value - operand
+        elif action == ACTIONS.MULTIPLY:
+            value = value * operand
+        elif action == ACTIONS.MIN:
+            value = max(value, operand)
+        elif action == ACTIONS.MAX:
+            value = min(value, operand)
+        if isinstance(value, float):
+            # unicode() rounds floats to 12 significant digits
+            form.data[fieldname] = repr(value)
+        else:
+            form.data[fieldname] = unicode(value)
+
     def _handle_action_add_m2m(self, fieldname, action, form, obj):
+        values = form.data.getlist(fieldname)
         for val in form.initial[fieldname]:
             val = unicode(val)  # Form values are always string, not int
-            if not val in form.data.getlist(fieldname):
-                form.data.appendlist(fieldname, val)
+            if not val in values:
+                values = values + [val]
+        form.data.setlist(fieldname, values)
 
     def _handle_action_define_m2m(self, fieldname, action, form, obj):
         if getattr(obj, fieldname).all():
@@ -324,3 +1488,8 @@ class MassAdmin(admin.ModelAdmin):
 
     def _handle_action_replace_m2m(self, fieldname, action, form, obj):
         pass  # replace is the default action
+
+    def _handle_action_remove_m2m(self, fieldname, action, form, obj):
+        removed = form.data.getlist(fieldname)
+        values = [unicode(val) for val in form.initial[fieldname]]  # Form values are always string, not int
+        form.data.setlist(fieldname, [val for val in values if val not in removed])
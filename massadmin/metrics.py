@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of mass change runs: duration and number of queries of each phase
+of a mass change (compiling the plan, fetching objects, validating forms,
+saving, logging, etc.), numbers of processed objects and sizes of batches.
+
+They are collected when someone asks for them (see
+`MassAdmin.get_mass_change_metrics`), and delivered through the
+`mass_change_metrics` signal and `MassAdmin.record_mass_change_metrics`.
+"""
+
+from contextlib import contextmanager
+import time
+
+from django.conf import settings
+from django.db.backends import util
+from django.utils.datastructures import SortedDict
+
+
+class _CountingCursor(util.CursorWrapper):
+
+    def __init__(self, cursor, db, counter):
+        super(_CountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+class QueryCounter(object):
+    """
+    Count the queries run on `connection` while it is used as a context
+    manager, without keeping them as the debug cursor does.
+
+    Queries are still recorded if they were, and counters can be nested.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def __enter__(self):
+        connection = self.connection
+        self._saved = connection.__dict__.get('make_debug_cursor'), connection.use_debug_cursor
+        if connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG):
+            make_cursor = connection.make_debug_cursor
+        else:
+            make_cursor = lambda cursor: util.CursorWrapper(cursor, connection)
+        connection.make_debug_cursor = lambda cursor: _CountingCursor(make_cursor(cursor), connection, self)
+        connection.use_debug_cursor = True
+        return self
+
+    def __exit__(self, *exc_info):
+        make_debug_cursor, self.connection.use_debug_cursor = self._saved
+        if make_debug_cursor is None:
+            del self.connection.make_debug_cursor
+        else:
+            self.connection.make_debug_cursor = make_debug_cursor
+
+
+class MassChangeMetrics(object):
+    """
+    Record of a mass change run: duration and number of queries of each of
+    its phases, numbers of processed, changed and skipped (already up to
+    date) objects, and sizes of its batches.
+    """
+
+    def __init__(self, connection):
+        self.queries = QueryCounter(connection)
+        self.phases = SortedDict()
+        self.batch_sizes = []
+        self.processed = 0
+        self.changed = None
+        self.skipped = None
+        self.seconds = None
+        self.error = None
+
+    @contextmanager
+    def running(self):
+        """
+        Record the whole run of the mass change, and its error if it fails.
+        """
+        start = time.time()
+        with self.queries:
+            try:
+                yield self
+            except Exception, e:
+                self.error = unicode(e)
+                raise
+            finally:
+                self.seconds = time.time() - start
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the duration and queries of the wrapped code to phase `name`.
+        """
+        start = time.time()
+        queries = self.queries.count
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {'seconds': 0, 'queries': 0, 'calls': 0})
+            phase['seconds'] += time.time() - start
+            phase['queries'] += self.queries.count - queries
+            phase['calls'] += 1
+
+    def add_batch(self, size):
+        self.batch_sizes.append(size)
+        self.processed += size
+
+    def set_counts(self, changed, skipped):
+        self.changed, self.skipped = changed, skipped
+
+    def as_dict(self):
+        """
+        Return the metrics as a JSON serializable dict.
+        """
+        return {
+            'seconds': self.seconds,
+            'queries': self.queries.count,
+            'phases': [dict(phase, name=name) for name, phase in self.phases.items()],
+            'processed': self.processed,
+            'changed': self.changed,
+            'skipped': self.skipped,
+            'batch_sizes': self.batch_sizes,
+            'error': self.error,
+        }
+
+    def __unicode__(self):
+        phases = [u'%s %.3fs (%s queries)' % (name, phase['seconds'], phase['queries'])
+                  for name, phase in self.phases.items()]
+        return u'%.3fs (%s queries): %s; %s processed, %s changed, %s skipped, %s batches' % (
+            self.seconds or 0, self.queries.count, u', '.join(phases),
+            self.processed, self.changed, self.skipped, len(self.batch_sizes))
+
+
+class NoMetrics(object):
+    """
+    Stand-in for MassChangeMetrics when no one collects them.
+    """
+
+    @contextmanager
+    def running(self):
+        yield self
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def add_batch(self, size):
+        pass
+
+    def set_counts(self, changed, skipped):
+        pass
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Mass change jobs, run outside of the admin request (see `massadmin.jobs`).
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import models
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from selection import encode_pks
+
+
+class MassChangeJob(models.Model):
+    """
+    A mass change applied outside of the admin request, by a local worker
+    (see `massadmin.jobs`).
+
+    The submitted mass change form is stored as is, to be validated and
+    applied again by the worker, on the selected objects.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'pending'),
+        (RUNNING, 'running'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+    )
+
+    content_type = models.ForeignKey(ContentType)
+    user = models.ForeignKey(User)
+    # Token of the selection in the user's session, for reference only
+    token = models.CharField(max_length=12, blank=True)
+    # Selected objects (see `selection.encode_pks`), or filters of the
+    # changelist where all objects were selected.
+    object_ids = models.TextField(blank=True)
+    query_string = models.TextField(null=True, blank=True)
+    # Urlencoded mass change form data.
+    data = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # Numbers of changed objects and of objects already up to date, once
+    # done, if the mass change knows them
+    changed = models.PositiveIntegerField(null=True, blank=True)
+    untouched = models.PositiveIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('created', )
+
+    @classmethod
+    def create(cls, request, model, token, object_ids, query_string=None):
+        """
+        Save the mass change submitted in `request` on the selection
+        `token`, that is `object_ids`, a list of primary keys of `model`
+        objects or, if all objects matching `query_string` changelist filters
+        were selected, their queryset.
+        """
+        job = cls(content_type=ContentType.objects.get_for_model(model), user=request.user, token=token,
+                  data=request.POST.urlencode())
+        if isinstance(object_ids, QuerySet):
+            job.query_string = query_string
+            job.total = object_ids.count()
+        else:
+            job.object_ids = encode_pks(model, object_ids)
+            job.total = len(object_ids)
+        job.save()
+        return job
+
+    def _get_cache_key(self):
+        return 'massadmin-job-%s' % self.pk
+
+    def start(self):
+        """
+        Claim the job, if it is still pending. Return False if another
+        worker already claimed it.
+        """
+        started = timezone.now()
+        claimed = MassChangeJob.objects.filter(pk=self.pk, status=self.PENDING).update(
+            status=self.RUNNING, started=started)
+        if claimed:
+            self.status = self.RUNNING
+            self.started = started
+        return bool(claimed)
+
+    def set_progress(self, **progress):
+        """
+        Record the number of `processed` and `failed` objects so far.
+
+        The job itself is only saved once finished, as it would not be
+        visible before the end of the mass change transaction: progress is
+        shared through the cache, which must be shared between processes
+        when jobs are not run in a thread of the web server.
+        """
+        for name, value in progress.items():
+            setattr(self, name, value)
+        cache.set(self._get_cache_key(), (self.processed, self.failed), 24 * 60 * 60)
+
+    def finish(self, error=None, counts=None):
+        """
+        Record the end of the job, with its `error` if it failed, or the
+        number of changed and untouched objects (`counts`) if known.
+        """
+        if error is None:
+            self.status = self.DONE
+            self.processed = self.total
+            if counts is not None:
+                self.changed, self.untouched = counts
+        else:
+            self.status = self.FAILED
+            self.error = error
+        self.finished = timezone.now()
+        self.save()
+        cache.delete(self._get_cache_key())
+
+    def get_progress(self):
+        """
+        Return a dict describing the status and progress of the job, with an
+        estimation of the number of seconds left to finish it (or None).
+        """
+        processed, failed = self.processed, self.failed
+        if self.status == self.RUNNING:
+            processed, failed = cache.get(self._get_cache_key(), (processed, failed))
+        eta = None
+        if self.status == self.RUNNING and processed:
+            elapsed = timezone.now() - self.started
+            eta = int(elapsed.total_seconds() * (self.total - processed) / processed)
+        return {
+            'status': self.status,
+            'total': self.total,
+            'processed': processed,
+            'changed': self.changed,
+            'untouched': self.untouched,
+            'failed': failed,
+            'eta': eta,
+            'error': self.error,
+        }
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Mass change plans: what a submitted mass change does, worked out once per
+request, then applied to each selected object.
+"""
+
+from collections import namedtuple
+from copy import copy
+
+from django.core import validators
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.forms.models import BaseModelForm
+from django.utils.datastructures import SortedDict
+
+from bulk import is_overridden
+
+
+class MassChangePlan(namedtuple('MassChangePlan', [
+        'form_class', 'fields', 'exclude_fields', 'actions', 'cleaned_values',
+        'find_options', 'operands', 'formsets', 'inline_formsets', 'select_related',
+        'prefetch_related', 'update_fields', 'data', 'files'])):
+    """
+    Compiled mass change (see `MassAdmin.get_mass_change_plan`):
+
+    - `form_class`: ModelForm class of each changed object, only holding the
+      mass changed fields if it can,
+    - `fields`: names of the mass changed fields,
+    - `exclude_fields`: names of the fields to remove from `form_class`
+      forms once created,
+    - `actions`: (field name, action) couples, for fields changed with
+      another action than the default one,
+    - `cleaned_values`: values of the fields whose submitted value is the
+      new value of every object, cleaned once for all forms, by field name
+      (see `MassAdmin.get_mass_change_plan`),
+    - `find_options`: (text to find, is a regular expression) couples for
+      fields changed with 'find and replace', by field name,
+    - `operands`: cleaned operands of numeric actions, by field name (None
+      if not valid, to let the form report the error),
+    - `formsets`: (FormSet, prefix) couples for inlines to mass change,
+      object by object,
+    - `inline_formsets`: valid inline formsets bound to a blank object,
+      whose new objects are created once for all changed objects (see
+      `MassAdmin.mass_change_bulk_inlines`),
+    - `select_related` and `prefetch_related`: relations to load along with
+      the changed objects (see `get_objects`),
+    - `update_fields`: names of the model fields to save, or None to save
+      all of them (see `get_update_fields`),
+    - `data` and `files`: the submitted data.
+    """
+
+    @classmethod
+    def compile(cls, ModelForm, exclude_fields, actions, cleaned_values, select_related=(), inline_formsets=(), **kwargs):
+        """
+        Return a plan changing the fields of `ModelForm` that are not in
+        `exclude_fields`, with `actions`, a {field name: action} dict, on
+        objects loaded with their `select_related` relations.
+
+        `cleaned_values` are values cleaned by form fields, that forms will
+        use instead of cleaning them again. They are validated by model
+        fields once too (see `_validate_cleaned_values`), while forms still
+        check the uniqueness of each object.
+        """
+        fields = tuple(fieldname for fieldname in ModelForm.base_fields if fieldname not in exclude_fields)
+        # Fields of the admin form left out of mass changed forms, that are
+        # unique together with mass changed fields
+        unique_with = set(fieldname for together in ModelForm._meta.model._meta.unique_together
+                          if set(together) & set(fields) for fieldname in together
+                          if fieldname in exclude_fields)
+        validated = _validate_cleaned_values(ModelForm._meta.model, cleaned_values)
+
+        class form_class(ModelForm):
+            def _get_validation_exclusions(self):
+                # Model fields don't validate values validated once already
+                return super(form_class, self)._get_validation_exclusions() + validated
+
+            def validate_unique(self):
+                # Left out fields still hold the values of the object, which
+                # are checked as the admin form would
+                exclude = [fieldname for fieldname in super(form_class, self)._get_validation_exclusions()
+                           if fieldname not in unique_with]
+                try:
+                    self.instance.validate_unique(exclude=exclude)
+                except ValidationError, e:
+                    self._update_errors(e.message_dict)
+        form_class.__name__ = ModelForm.__name__
+
+        if exclude_fields and not is_overridden(ModelForm, '__init__', BaseModelForm):
+            # Forms will only hold mass changed fields from the start.
+            # Custom forms may expect their fields in __init__ though, so
+            # they still get all of them.
+            base_fields = [(fieldname, ModelForm.base_fields[fieldname]) for fieldname in fields]
+            # Also spare loading initial values of other fields
+            form_class._meta.fields = list(fields)
+            exclude_fields = ()
+        else:
+            base_fields = ModelForm.base_fields.items()
+        form_class.base_fields = SortedDict(
+            (fieldname, fieldname in cleaned_values and _cleaned_field(field, cleaned_values[fieldname]) or field)
+            for fieldname, field in base_fields)
+        # Many-to-many fields whose values are loaded by forms as initial
+        # values, and by some actions
+        opts = form_class._meta
+        prefetch_related = tuple(field.name for field in opts.model._meta.many_to_many
+                                 if field.editable and (opts.fields is None or field.name in opts.fields)
+                                 and not (opts.exclude and field.name in opts.exclude))
+        return cls(form_class=form_class, fields=fields, exclude_fields=tuple(exclude_fields),
+                   actions=tuple(actions.items()), cleaned_values=cleaned_values,
+                   inline_formsets=tuple(inline_formsets), select_related=tuple(select_related),
+                   prefetch_related=prefetch_related, update_fields=get_update_fields(opts.model, fields), **kwargs)
+
+    def get_action(self, fieldname, default=None):
+        return dict(self.actions).get(fieldname, default)
+
+    def get_objects(self, queryset, prefetch=True):
+        """
+        Return `queryset` loading the relations needed to change and log
+        its objects with a constant number of queries. Prefetching is done
+        when the queryset is evaluated, so it must not be iterated with
+        `iterator()` if `prefetch` is True.
+        """
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if prefetch and self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
+    def get_form(self, obj):
+        """
+        Return the form changing `obj`. Actions may then alter its data,
+        which is a copy of the submitted one.
+        """
+        data = self.data
+        if self.actions:
+            # Lists of values are shared with the submitted data, so they
+            # must be replaced instead of being altered.
+            data = copy(data)
+        form = self.form_class(data, self.files, instance=obj)
+        for fieldname in self.exclude_fields:
+            del form.fields[fieldname]
+        return form
+
+    def get_formsets(self, obj):
+        """
+        Return the inline formsets changing `obj`.
+        """
+        return [FormSet(self.data, self.files, instance=obj, prefix=prefix)
+                for FormSet, prefix in self.formsets]
+
+
+def get_update_fields(model, fieldnames):
+    """
+    Return the names of the columns of `model` to save when changing
+    `fieldnames`, including dates updated on save (see `bulk.save_fields`),
+    or None if they can't be saved alone (custom save methods may change
+    other fields) or if only many-to-many fields are changed.
+    """
+    if is_overridden(model, 'save', models.Model):
+        return None
+    update_fields = [field.name for field in model._meta.fields
+                     if field.name in fieldnames and not field.primary_key]
+    if not update_fields:
+        return None
+    return tuple(update_fields + [field.name for field in model._meta.fields
+                                  if isinstance(field, models.DateField) and field.auto_now])
+
+
+def _validate_cleaned_values(model, cleaned_values):
+    """
+    Validate `cleaned_values` with the fields of `model`, like
+    Model.clean_fields() does, on a blank instance: their validation does not
+    depend on the changed object, so that a foreign key is looked up once
+    instead of once per object.
+
+    Return the names of the fields whose value is valid. Invalid ones are
+    left to each form, to report their errors.
+    """
+    instance = model()
+    validated = []
+    for field in model._meta.fields:
+        if field.name not in cleaned_values:
+            continue
+        try:
+            # Assigning None to a required foreign key raises ValueError
+            field.save_form_data(instance, cleaned_values[field.name])
+            raw_value = getattr(instance, field.attname)
+            if not (field.blank and raw_value in validators.EMPTY_VALUES):
+                field.clean(raw_value, instance)
+        except (ValueError, ValidationError):
+            continue
+        validated.append(field.name)
+    return validated
+
+
+def _cleaned_field(field, value):
+    """
+    Return a copy of form field `field` whose value is always cleaned as
+    `value`.
+    """
+    field = copy(field)
+    field.clean = lambda *args: value
+    return field
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of mass change selections in the user's session.
+
+Selected primary keys are stored once, compactly, under a short random
+token that is then the only thing passed around in mass change URLs.
+When all the objects matching the changelist filters are selected, only
+those filters are stored, so that the selection can be evaluated again
+when the mass change is applied. Tokens expire on their own after a given
+time.
+"""
+
+import base64
+import time
+import zlib
+
+from django.db import models
+from django.utils import simplejson
+from django.utils.crypto import get_random_string
+
+SESSION_KEY = '_massadmin_selections'
+
+
+def _has_integer_pk(model):
+    pk = model._meta.pk
+    return isinstance(pk, (models.AutoField, models.IntegerField)) and not pk.rel
+
+
+def encode_pks(model, pks):
+    """
+    Pack `pks`, primary keys of `model` objects, in a compact string.
+
+    Integer primary keys are sorted and delta-encoded before being
+    compressed, which makes even huge selections of contiguous objects
+    weigh a few bytes. Other primary keys are just compressed.
+    """
+    if _has_integer_pk(model):
+        pks = sorted(set(int(pk) for pk in pks))
+        deltas = [b - a for a, b in zip([0] + pks, pks)]
+        data = ','.join('%x' % delta for delta in deltas)
+    else:
+        data = simplejson.dumps([unicode(pk) for pk in pks])
+    return base64.b64encode(zlib.compress(data))
+
+
+def decode_pks(model, data):
+    """
+    Return the list of primary keys packed in `data` by `encode_pks`.
+    """
+    data = zlib.decompress(base64.b64decode(data))
+    if not _has_integer_pk(model):
+        return simplejson.loads(data)
+    pks = []
+    pk = 0
+    for delta in filter(None, data.split(',')):
+        pk += int(delta, 16)
+        pks.append(pk)
+    return pks
+
+
+def _get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def _save(request, model, value, timeout):
+    now = time.time()
+    selections = dict((token, selection) for token, selection in request.session.get(SESSION_KEY, {}).items()
+                      if selection[1] > now)
+    token = get_random_string(12)
+    selections[token] = (_get_label(model), now + timeout) + value
+    request.session[SESSION_KEY] = selections
+    return token
+
+
+def save_selection(request, model, pks, timeout):
+    """
+    Store `pks`, primary keys of selected `model` objects, in the session
+    for `timeout` seconds, and return the token identifying them.
+    Expired selections are purged on the way.
+    """
+    return _save(request, model, (encode_pks(model, pks), None), timeout)
+
+
+def save_filters(request, model, query_string, timeout):
+    """
+    Store `query_string`, the filter and search parameters of the
+    changelist where all `model` objects were selected, in the session for
+    `timeout` seconds, and return the token identifying them.
+    """
+    return _save(request, model, (None, query_string), timeout)
+
+
+def load_selection(request, model, token):
+    """
+    Return a (primary keys, query string) tuple for the `model` objects
+    stored under `token`, only one of them being set depending on how the
+    selection was saved (see `save_selection` and `save_filters`).
+    Return None if there is no such selection (or if it has expired).
+    """
+    selection = request.session.get(SESSION_KEY, {}).get(token)
+    if selection is None:
+        return None
+    label, expires, data, query_string = selection
+    if label != _get_label(model) or expires < time.time():
+        return None
+    if query_string is not None:
+        return None, query_string
+    return decode_pks(model, data), None
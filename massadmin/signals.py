@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Signals sent for each batch of objects of a mass change (see
+`MassAdmin.mass_change_batch_size`), with the mass changed model as sender:
+
+- `queryset`: the objects of the batch,
+- `pks`: their primary keys,
+- `fields`: names of the mass changed fields,
+- `actions`: {field name: action} dict of the actions done on them,
+- `request`: the request of the mass change.
+
+`pre_mass_change` is sent before the batch is changed, `post_mass_change`
+after. Receivers can process a whole batch at once (to update a search
+index, purge a cache, etc.), and even replace receivers of per object
+signals with `MassAdmin.mass_change_suppress_row_signals`.
+
+`mass_change_metrics` is sent once a mass change is done (or has failed),
+with the mass changed model as sender:
+
+- `metrics`: the metrics of the run, as a dict (see
+  `massadmin.metrics.MassChangeMetrics.as_dict`),
+- `request`: the request of the mass change.
+"""
+
+from django.dispatch import Signal
+
+pre_mass_change = Signal(providing_args=['queryset', 'pks', 'fields', 'actions', 'request'])
+post_mass_change = Signal(providing_args=['queryset', 'pks', 'fields', 'actions', 'request'])
+mass_change_metrics = Signal(providing_args=['metrics', 'request'])
@@ -8,11 +8,13 @@ register = template.Library()
 
 
 @register.inclusion_tag('massadmin/mass_options_form.html', takes_context=True)
-def render_mass_options_for_field(context, field_name, field=None):
+def render_mass_options_for_field(context, field_name, field=None, part=None):
     """
     Render mass options form for a given model's field or inline.
 
     If `field` is not given, it means `field_name` identifies an inline.
+    `part` may be "checkbox" to only render the "mass change" checkbox, or
+    "advanced" to only render the other options.
     """
     try:
         mass_actions_options_form = context['mass_actions_options_form']
@@ -22,5 +24,6 @@ def render_mass_options_for_field(context, field_name, field=None):
     form = mass_actions_options_form(field_name=field_name, field=field)
 
     return {
-        'form': form
+        'form': form,
+        'part': part,
     }
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager
+
+from django.contrib import admin
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.core.management import call_command
 from django.db.models import loading
 from django.contrib.auth.models import User
+from django.contrib.admin import ACTION_CHECKBOX_NAME
 
 from django_webtest import WebTest
 
@@ -21,19 +25,46 @@ class BaseTest(WebTest):
         insts are Boat instances to mass edit.
         """
         info = Boat._meta.app_label, Boat._meta.module_name
-        selected = ','.join(str(i.pk) for i in instances)
-        massadmin_url = reverse('admin:%s_%s_massadmin' % info, args=(selected,), )
-        response = self.app.get(massadmin_url, user=self.user)
+        changelist_url = reverse('admin:%s_%s_changelist' % info)
+        form = self.app.get(changelist_url, user=self.user).forms['changelist-form']
+        selected = set(str(i.pk) for i in instances)
+        for index in range(len(form.fields[ACTION_CHECKBOX_NAME])):
+            checkbox = form.get(ACTION_CHECKBOX_NAME, index=index)
+            checkbox.checked = checkbox._value in selected
+        form['action'] = 'mass_change_selected'
+        response = form.submit().follow()
         return response.forms['boat_form']
 
+    @contextmanager
+    def admin_options(self, **options):
+        """
+        Override options of the Boat admin within a `with` block, which
+        gets the admin.
+        """
+        boat_admin = admin.site._registry[Boat]
+        previous = dict((name, boat_admin.__dict__[name]) for name in options if name in boat_admin.__dict__)
+        for name, value in options.items():
+            setattr(boat_admin, name, value)
+        try:
+            yield boat_admin
+        finally:
+            for name in options:
+                if name in previous:
+                    setattr(boat_admin, name, previous[name])
+                else:
+                    delattr(boat_admin, name)
+
     def update_form(self, form, **kwargs):
         """
         Just pass fields to change as kwargs.
         If you want a special action (replace, define, append, ...)
         pass yourfieldname_action kwargs with the right value.
+        For find and replace action, pass the text to find as
+        yourfieldname_find kwarg (and yourfieldname_regex=True if it is a
+        regular expression).
         """
         for field_name, field_value in kwargs.iteritems():
-            if field_name.endswith("_action"):
+            if field_name.endswith(("_action", "_find", "_regex")):
                 # it's not a field, but the action requested for this field
                 continue
             form[field_name] = field_value
@@ -43,6 +74,9 @@ class BaseTest(WebTest):
             if action in kwargs:
                 # A non default action is requested
                 form['_mass_change_%s_action' % field_name] = kwargs[action]
+            for option in ("find", "regex"):
+                if "%s_%s" % (field_name, option) in kwargs:
+                    form['_mass_change_%s_%s' % (field_name, option)] = kwargs["%s_%s" % (field_name, option)]
 
     def update_inlines(self, form, **kwargs):
         """
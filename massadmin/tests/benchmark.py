@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of mass changes on the test models, run on the test database
+of the test suite (see `BenchmarkTest`):
+
+    MASSADMIN_BENCHMARK_SIZES=1000,10000,100000 ./manage.py test massadmin.BenchmarkTest
+
+writes the report as JSON to `MASSADMIN_BENCHMARK_OUTPUT` (default:
+massadmin-benchmark.json).
+
+For each benchmarked action and each selection size, boats are seeded in
+bulk, then the mass change is submitted to `MassAdmin.mass_change_view`,
+recording its wall time, number of queries and peak memory.
+"""
+
+import datetime
+import gc
+import platform
+import resource
+import threading
+import time
+
+import django
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
+from django.contrib.messages.storage import default_storage
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test.client import RequestFactory
+from django.utils.importlib import import_module
+
+from .. import selection
+from ..bulk import chunked, delete_queryset
+from ..metrics import QueryCounter
+from .boats.models import Boat, BoatToRace, Captain, Race
+
+ACTIONS = ('replace', 'replace_per_object', 'define', 'prepend', 'append',
+           'm2m_add', 'm2m_replace', 'inline', 'inline_bulk')
+SIZES = (1000, 10000, 100000)
+
+
+# Fields with mass actions always submit one
+DEFAULT_DATA = dict(('_mass_change_%s_action' % fieldname, 'replace')
+                    for fieldname in ('name', 'architect', 'length', 'previous_captains'))
+
+
+def _field(fieldname, value, action='replace'):
+    return dict(DEFAULT_DATA, **{
+        '_mass_change_%s' % fieldname: 'on',
+        '_mass_change_%s_action' % fieldname: action,
+        fieldname: value,
+    })
+
+
+def get_action(name, captains, races):
+    """
+    Return the data submitted for benchmarked action `name`, and the
+    MassAdmin options it is run with.
+    """
+    inline = dict(DEFAULT_DATA, **{
+        '_mass_change_boattorace_set': 'on',
+        'boattorace_set-TOTAL_FORMS': '1',
+        'boattorace_set-INITIAL_FORMS': '0',
+        'boattorace_set-MAX_NUM_FORMS': '',
+        'boattorace_set-0-race': races[0].pk,
+        'boattorace_set-0-victory_date': '2002-02-20',
+    })
+    return {
+        'replace': (_field('rigging', Boat.KETCH), {}),
+        'replace_per_object': (_field('rigging', Boat.KETCH), {'mass_change_bulk_update': False}),
+        'define': (_field('architect', 'Herbulot', 'define'), {}),
+        'prepend': (_field('name', 'The ', 'prepend'), {}),
+        'append': (_field('name', ' II', 'append'), {}),
+        'm2m_add': (_field('previous_captains', [captain.pk for captain in captains[:2]], 'add'), {}),
+        'm2m_replace': (_field('previous_captains', [captain.pk for captain in captains[:2]], 'replace'), {}),
+        'inline': (inline, {}),
+        'inline_bulk': (inline, {'mass_change_bulk_inlines': True}),
+    }[name]
+
+
+def seed(size):
+    """
+    Replace all boats by `size` new ones, created in bulk: half of them
+    have an architect, each has a previous captain.
+    Return the captains, the races and the primary keys of the boats.
+    """
+    for model in (LogEntry, BoatToRace, Boat.previous_captains.through, Boat, Captain, Race):
+        delete_queryset(model.objects.all())
+    captains = [Captain.objects.create(name="Captain %s" % i, birthday=datetime.date(1966, 3, 21))
+                for i in range(10)]
+    races = [Race.objects.create(name="Race %s" % i) for i in range(5)]
+    # Chunks stay under SQLite's limit of parameters per query
+    for chunk in chunked(xrange(size), 100):
+        Boat.objects.bulk_create([
+            Boat(name="Boat %s" % i, architect=i % 2 and "Tabarly" or None, length=10,
+                 captain=captains[i % len(captains)])
+            for i in chunk
+        ])
+    pks = list(Boat.objects.values_list('pk', flat=True))
+    through = Boat.previous_captains.through
+    for chunk in chunked(pks, 100):
+        through.objects.bulk_create([
+            through(boat_id=pk, captain_id=captains[pk % len(captains)].pk)
+            for pk in chunk
+        ])
+    return captains, races, pks
+
+
+def _get_rss():
+    """
+    Return the resident memory of the process, in kilobytes, or its peak
+    resident memory where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PeakMemory(object):
+    """
+    Sample the resident memory of the process while running, to get how
+    much it grew at most, in kilobytes.
+    """
+    interval = 0.01
+
+    def __enter__(self):
+        self.start = self.peak = _get_rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, _get_rss())
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, _get_rss())
+
+    @property
+    def increase(self):
+        return self.peak - self.start
+
+
+def run_benchmark(sizes=SIZES, actions=ACTIONS, using=DEFAULT_DB_ALIAS):
+    """
+    Run each of `actions` on each selection size of `sizes`, and return the
+    report, a JSON serializable dict.
+    """
+    boat_admin = admin.site._registry[Boat]
+    connection = connections[using]
+    user, created = User.objects.get_or_create(username='massadmin-benchmark', defaults={
+        'is_staff': True,
+        'is_superuser': True,
+    })
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    results = []
+    for size in sizes:
+        for name in actions:
+            captains, races, pks = seed(size)
+            data, options = get_action(name, captains, races)
+            request = RequestFactory().post('/', dict(data, _save='Save'))
+            request.user = user
+            request.session = SessionStore()
+            request._messages = default_storage(request)
+            token = selection.save_selection(request, Boat, pks, 60 * 60)
+            for option, value in options.items():
+                setattr(boat_admin, option, value)
+            gc.collect()
+            try:
+                with QueryCounter(connection) as queries:
+                    with PeakMemory() as memory:
+                        start = time.time()
+                        response = boat_admin.mass_change_view(request, token)
+                        seconds = time.time() - start
+            finally:
+                for option in options:
+                    delattr(boat_admin, option)
+            results.append({
+                'action': name,
+                'size': size,
+                'status_code': response.status_code,
+                'seconds': round(seconds, 4),
+                'queries': queries.count,
+                'peak_memory_kb': memory.increase,
+            })
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'results': results,
+    }
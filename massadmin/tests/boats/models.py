@@ -39,6 +39,7 @@ class Boat(BaseModel):
     architect = models.CharField(max_length=100, null=True, blank=True)
     length = models.FloatField()
     rigging = models.SmallIntegerField(choices=RIGGING, default=SLOOP)
+    plan = models.FileField(upload_to="plans", null=True, blank=True)
 
     captain = models.ForeignKey(Captain, related_name="boat")
 
@@ -58,7 +59,7 @@ class BoatToRaceInline(admin.TabularInline):
 
 class BoatAdmin(MassAdmin):
     inlines = (BoatToRaceInline, )
-    exclude = ('win_races', )
+    exclude = ('win_races', 'plan')
 admin.site.register(Boat, BoatAdmin)
 
 
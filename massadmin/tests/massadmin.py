@@ -1,11 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import os
+import shutil
+import tempfile
+import urllib
+from StringIO import StringIO
+
 try:
     from django.test.utils import override_settings
 except ImportError:
     from override_settings import override_settings
 
-from .boats.models import Boat
+from django.contrib import admin
+from django.contrib.admin import ACTION_CHECKBOX_NAME
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.urlresolvers import reverse
+from django import forms
+from django.forms.models import modelform_factory
+from django.test.client import RequestFactory
+from django.db import connection
+from django.db.models import signals
+from django.utils import simplejson
+from django.utils.unittest import skipUnless
+
+from .. import selection
+from ..jobs import run_job, run_pending_jobs
+from ..models import MassChangeJob
+from ..signals import pre_mass_change, post_mass_change, mass_change_metrics
+
+from .benchmark import run_benchmark
+from .boats.models import Boat, BoatToRace, Captain
 from .base import BaseTest
 
 
@@ -35,6 +63,17 @@ class CharFieldTest(BaseTest):
         self.assertEqual(Boat.objects.get(pk=b3.pk).architect, architect)
         self.assertNotEqual(Boat.objects.get(pk=b4.pk).architect, architect)
 
+    def test_define_reports_defined_count(self):
+        b1 = self.F.Boat(architect="")
+        b2 = self.F.Boat(architect="Bruce Farr")  # Should not be modified
+        b3 = self.F.Boat()
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, architect=u"William Fife", architect_action="define")
+        response = form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).architect, u"William Fife")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).architect, u"Bruce Farr")
+        self.assertTrue("Architect was defined on 2 of the selected boats." in response)
+
     def test_replace(self):
         b1 = self.F.Boat()
         b2 = self.F.Boat(architect="Bruce Farr")
@@ -69,6 +108,110 @@ class CharFieldTest(BaseTest):
         self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Pen Duick")
         self.assertEqual(Boat.objects.get(pk=b3.pk).name, "Pen Duick")
 
+    def test_append_to_empty_value(self):
+        b1 = self.F.Boat(architect="Eric")
+        b2 = self.F.Boat()
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, architect=" Tabarly", architect_action="append")
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).architect, "Eric Tabarly")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).architect, " Tabarly")
+
+    def test_append_to_empty_value_without_bulk(self):
+        for action, expected in (("append", "Eric Tabarly"), ("prepend", " TabarlyEric")):
+            b1 = self.F.Boat(architect="Eric")
+            b2 = self.F.Boat(architect=None)
+            with self.admin_options(mass_change_bulk_update=False):
+                form = self.get_massadmin_form(b1, b2)
+                self.update_form(form, architect=" Tabarly", architect_action=action)
+                form.submit().follow()
+            self.assertEqual(Boat.objects.get(pk=b1.pk).architect, expected)
+            self.assertEqual(Boat.objects.get(pk=b2.pk).architect, " Tabarly")
+
+    def test_append_max_length(self):
+        b1 = self.F.Boat(name="Pen Duick")
+        b2 = self.F.Boat(name="P" * 96)
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, name=" VIII", name_action="append")
+        self.assertRaises(Exception, form.submit)
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "P" * 96)
+
+
+class FindReplaceTest(BaseTest):
+
+    def test_find_replace(self):
+        b1 = self.F.Boat(name="Pen Duick II")
+        b2 = self.F.Boat(name="Pen Duick III")
+        b3 = self.F.Boat(name="Kriter")
+        b4 = self.F.Boat(name="Pen Duick IV")  # Will not be edited
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, name="Penn", name_action="find_replace", name_find="Pen")
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Penn Duick II")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Penn Duick III")
+        self.assertEqual(Boat.objects.get(pk=b3.pk).name, "Kriter")
+        self.assertEqual(Boat.objects.get(pk=b4.pk).name, "Pen Duick IV")
+
+    def test_find_replace_by_nothing(self):
+        b1 = self.F.Boat(name="Pen Duick II")
+        form = self.get_massadmin_form(b1)
+        self.update_form(form, name="", name_action="find_replace", name_find=" II")
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick")
+
+    def test_find_replace_regex(self):
+        b1 = self.F.Boat(name="Pen Duick II")
+        b2 = self.F.Boat(name="Pen Duick 3")
+        b3 = self.F.Boat(name="Kriter")
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, name=r"\1 (\2)", name_action="find_replace", name_find=r"^(.*) ([IV0-9]+)$", name_regex=True)
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick (II)")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Pen Duick (3)")
+        self.assertEqual(Boat.objects.get(pk=b3.pk).name, "Kriter")
+
+    def test_find_replace_case_sensitive(self):
+        b1 = self.F.Boat(name="Pen Duick")
+        b2 = self.F.Boat(name="PEN DUICK")
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, name="Penn", name_action="find_replace", name_find="Pen")
+        preview = form.submit('_preview').context['preview']
+        self.assertEqual([(field['changed'], field['unchanged']) for field in preview['fields']], [(1, 1)])
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Penn Duick")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "PEN DUICK")
+        self.assertEqual([entry.object_id for entry in LogEntry.objects.all()], [unicode(b1.pk)])
+
+    def test_find_replace_regex_grouped_by_value(self):
+        b1 = self.F.Boat(name="Pen Duick II")
+        b2 = self.F.Boat(name="Pen Duick III")
+        b3 = self.F.Boat(name="Kriter V")
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, name="", name_action="find_replace", name_find=r" [IV]+$", name_regex=True)
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            form.submit()
+        finally:
+            connection.use_debug_cursor = None
+        # SQLite can't replace regular expressions: one UPDATE per new value
+        updates = [query for query in connection.queries[start:] if query['sql'].startswith('UPDATE "boats_boat"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Pen Duick")
+        self.assertEqual(Boat.objects.get(pk=b3.pk).name, "Kriter")
+
+    def test_find_replace_without_bulk(self):
+        b1 = self.F.Boat(name="Pen Duick II")
+        b2 = self.F.Boat(name="Kriter")
+        with self.admin_options(mass_change_bulk_update=False):
+            form = self.get_massadmin_form(b1, b2)
+            self.update_form(form, name="Penn", name_action="find_replace", name_find="Pen")
+            form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Penn Duick II")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Kriter")
+
 
 class ChoicesFieldTest(BaseTest):
 
@@ -96,12 +239,17 @@ class ChoicesFieldTest(BaseTest):
 
 class FloatFieldTest(BaseTest):
 
-    def test_no_action_available(self):
-        # append, prepend, etc., makes no sense for a float field
+    def test_numeric_actions_available(self):
+        # append, prepend, etc., makes no sense for a float field, but
+        # arithmetic does
         b1 = self.F.Boat()
         b2 = self.F.Boat()
         form = self.get_massadmin_form(b1, b2)
-        self.assertTrue("_mass_change_length_action" not in form.fields)
+        self.assertTrue("_mass_change_length_action" in form.fields)
+        self.assertEqual(
+            [option[0] for option in form['_mass_change_length_action'].options],
+            ['replace', 'add', 'subtract', 'multiply', 'min', 'max']
+        )
 
     def test_replace_floatfield(self):
         b1 = self.F.Boat()
@@ -114,6 +262,48 @@ class FloatFieldTest(BaseTest):
         self.assertEqual(Boat.objects.get(pk=b2.pk).length, 13.2)
         self.assertEqual(Boat.objects.get(pk=b3.pk).length, b3.length)
 
+    def test_arithmetic(self):
+        for action, expected in (("add", 12.5), ("subtract", 7.5), ("multiply", 25)):
+            b1 = self.F.Boat(length=10)
+            b2 = self.F.Boat(length=5)  # Will not be edited
+            form = self.get_massadmin_form(b1)
+            self.update_form(form, length=2.5, length_action=action)
+            form.submit().follow()
+            self.assertEqual(Boat.objects.get(pk=b1.pk).length, expected)
+            self.assertEqual(Boat.objects.get(pk=b2.pk).length, 5)
+
+    def test_clamp(self):
+        b1 = self.F.Boat(length=10)
+        b2 = self.F.Boat(length=20)
+        b3 = self.F.Boat(length=30)
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, length=15, length_action="min")
+        form.submit().follow()
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, length=25, length_action="max")
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).length, 15)
+        self.assertEqual(Boat.objects.get(pk=b2.pk).length, 20)
+        self.assertEqual(Boat.objects.get(pk=b3.pk).length, 25)
+
+    def test_arithmetic_without_bulk(self):
+        b1 = self.F.Boat(length=10)
+        b2 = self.F.Boat(length=20)
+        with self.admin_options(mass_change_bulk_update=False):
+            form = self.get_massadmin_form(b1, b2)
+            self.update_form(form, length=1.5, length_action="multiply")
+            form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).length, 15)
+        self.assertEqual(Boat.objects.get(pk=b2.pk).length, 30)
+
+    def test_arithmetic_without_bulk_keeps_precision(self):
+        b1 = self.F.Boat(length=1.0 / 3)
+        with self.admin_options(mass_change_bulk_update=False):
+            form = self.get_massadmin_form(b1)
+            self.update_form(form, length=1, length_action="add")
+            form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).length, 1.0 / 3 + 1)
+
 
 class ForeignKeyTest(BaseTest):
 
@@ -141,6 +331,30 @@ class ForeignKeyTest(BaseTest):
         self.assertEqual(Boat.objects.get(pk=b2.pk).captain, c3)
         self.assertEqual(Boat.objects.get(pk=b3.pk).captain, c1)
 
+    def test_replace_foreignkey_cleaned_once(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        boats = [self.F.Boat(captain=c1) for i in range(5)]
+        form = self.get_massadmin_form(*boats)
+        self.update_form(form, captain=c2.pk, previous_captains=[c1.pk, c2.pk], previous_captains_action="replace")
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            with self.admin_options(mass_change_bulk_update=False):
+                form.submit()
+        finally:
+            connection.use_debug_cursor = None
+        # Chosen captains are looked up once when cleaning the form, and the
+        # chosen captain once more when validated by the model field, not
+        # for each boat
+        lookups = [query for query in connection.queries[start:]
+                   if query['sql'].startswith('SELECT') and 'FROM "boats_captain" WHERE' in query['sql']]
+        self.assertEqual(len(lookups), 3)
+        for boat in boats:
+            boat = Boat.objects.get(pk=boat.pk)
+            self.assertEqual(boat.captain, c2)
+            self.assertEqual(set(boat.previous_captains.all()), set([c1, c2]))
+
 
 class ManyToManyFieldTest(BaseTest):
 
@@ -201,6 +415,77 @@ class ManyToManyFieldTest(BaseTest):
         self.assertEqual(set(Boat.objects.get(pk=b2.pk).previous_captains.all()), set([c3, c1]))
         self.assertEqual(set(Boat.objects.get(pk=b3.pk).previous_captains.all()), set([c3]))
 
+    def test_remove_manytomany(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        c3 = self.F.Captain()
+        b1 = self.F.Boat(captain=c1, previous_captains=[c1, c2, c3])
+        b2 = self.F.Boat(captain=c2, previous_captains=[c3])
+        b3 = self.F.Boat(captain=c1, previous_captains=[c1, c3])  # Will not be edited
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, previous_captains=[c1.pk, c3.pk], previous_captains_action="remove")
+        form.submit().follow()
+        self.assertEqual(set(Boat.objects.get(pk=b1.pk).previous_captains.all()), set([c2]))
+        self.assertEqual(set(Boat.objects.get(pk=b2.pk).previous_captains.all()), set())
+        self.assertEqual(set(Boat.objects.get(pk=b3.pk).previous_captains.all()), set([c1, c3]))
+
+    def test_remove_manytomany_without_bulk(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        b1 = self.F.Boat(captain=c1, previous_captains=[c1, c2])
+        b2 = self.F.Boat(captain=c2, previous_captains=[c2])
+        with self.admin_options(mass_change_bulk_update=False):
+            form = self.get_massadmin_form(b1, b2)
+            self.update_form(form, previous_captains=[c1.pk], previous_captains_action="remove")
+            form.submit().follow()
+        self.assertEqual(set(Boat.objects.get(pk=b1.pk).previous_captains.all()), set([c2]))
+        self.assertEqual(set(Boat.objects.get(pk=b2.pk).previous_captains.all()), set([c2]))
+
+    def test_add_manytomany_without_bulk(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        c3 = self.F.Captain()
+        b1 = self.F.Boat(captain=c1, previous_captains=[c2])
+        b2 = self.F.Boat(captain=c2)
+        with self.admin_options(mass_change_bulk_update=False):
+            form = self.get_massadmin_form(b1, b2)
+            self.update_form(form, previous_captains=[c3.pk], previous_captains_action="add")
+            form.submit().follow()
+        # Values added for an object are not added to the next ones
+        self.assertEqual(set(Boat.objects.get(pk=b1.pk).previous_captains.all()), set([c2, c3]))
+        self.assertEqual(set(Boat.objects.get(pk=b2.pk).previous_captains.all()), set([c3]))
+
+    def test_m2m_changed_sent(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        b1 = self.F.Boat(previous_captains=[c1])
+        b2 = self.F.Boat(previous_captains=[c1, c2])  # Already up to date
+        b3 = self.F.Boat()
+        sent = []
+
+        def on_m2m_changed(sender, instance, action, pk_set, **kwargs):
+            sent.append((action, instance.pk, pk_set))
+        signals.m2m_changed.connect(on_m2m_changed, sender=Boat.previous_captains.through)
+        try:
+            form = self.get_massadmin_form(b1, b2, b3)
+            self.update_form(form, previous_captains=[c2.pk], previous_captains_action="replace")
+            form.submit().follow()
+        finally:
+            signals.m2m_changed.disconnect(on_m2m_changed, sender=Boat.previous_captains.through)
+        self.assertEqual(set(Boat.objects.get(pk=b1.pk).previous_captains.all()), set([c2]))
+        self.assertEqual(set(Boat.objects.get(pk=b2.pk).previous_captains.all()), set([c2]))
+        self.assertEqual(set(Boat.objects.get(pk=b3.pk).previous_captains.all()), set([c2]))
+        self.assertEqual(sorted(sent), sorted([
+            ('pre_remove', b1.pk, set([c1.pk])),
+            ('post_remove', b1.pk, set([c1.pk])),
+            ('pre_remove', b2.pk, set([c1.pk])),
+            ('post_remove', b2.pk, set([c1.pk])),
+            ('pre_add', b1.pk, set([c2.pk])),
+            ('post_add', b1.pk, set([c2.pk])),
+            ('pre_add', b3.pk, set([c2.pk])),
+            ('post_add', b3.pk, set([c2.pk])),
+        ]))
+
 
 @override_settings(DATE_INPUT_FORMATS=('%Y/%m/%d', ))
 class InlineTest(BaseTest):
@@ -237,3 +522,766 @@ class InlineTest(BaseTest):
         self.assertEqual(set(Boat.objects.get(pk=b1.pk).win_races.all()), set([r1, r2, r3]))
         self.assertEqual(set(Boat.objects.get(pk=b2.pk).win_races.all()), set([r1, r3]))
         self.assertEqual(set(Boat.objects.get(pk=b3.pk).win_races.all()), set([r3]))
+
+    def add_races(self, *boats):
+        r1 = self.F.Race()
+        r2 = self.F.Race()
+        form = self.get_massadmin_form(*boats)
+        self.update_inlines(form, boattorace=[
+            {'race': r1.pk, 'victory_date': '1999/10/10'},
+            {'race': r2.pk, 'victory_date': '1977/10/10'},
+        ])
+        form.submit().follow()
+        return r1, r2
+
+    def test_add_once_per_object(self):
+        boats = [self.F.Boat() for i in range(3)]
+        r1, r2 = self.add_races(*boats)
+        for boat in boats:
+            self.assertEqual(sorted(BoatToRace.objects.filter(boat=boat).values_list('race', flat=True)),
+                             [r1.pk, r2.pk])
+
+    def test_add_in_bulk(self):
+        r3 = self.F.Race()
+        boats = [self.F.Boat(boattorace=[(r3, None)]) for i in range(3)]
+        with self.admin_options(mass_change_bulk_inlines=True, mass_change_batch_size=2):
+            r1, r2 = self.add_races(*boats)
+        for boat in boats:
+            self.assertEqual(sorted(BoatToRace.objects.filter(boat=boat).values_list('race', flat=True)),
+                             sorted([r1.pk, r2.pk, r3.pk]))
+        self.assertEqual(BoatToRace.objects.get(boat=boats[2], race=r1).victory_date, datetime.date(1999, 10, 10))
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), 3)
+        self.assertTrue(LogEntry.objects.all()[0].change_message.startswith("Added boat to race"))
+
+    def test_unique_not_in_bulk(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.admin_options(mass_change_bulk_inlines=True) as boat_admin:
+            FormSet = list(boat_admin.get_formsets(request))[0]
+            self.assertTrue(boat_admin._can_mass_change_inline_in_bulk(FormSet))
+            BoatToRace._meta.unique_together = (('boat', 'race'), )
+            try:
+                # New objects would be checked against a blank boat
+                self.assertFalse(boat_admin._can_mass_change_inline_in_bulk(FormSet))
+            finally:
+                BoatToRace._meta.unique_together = ()
+
+
+class FileFieldTest(BaseTest):
+
+    def setUp(self):
+        super(FileFieldTest, self).setUp()
+        self.field = Boat._meta.get_field('plan')
+        self.storage = self.field.storage
+        self.location = tempfile.mkdtemp()
+        self.field.storage = FileSystemStorage(location=self.location)
+
+    def tearDown(self):
+        self.field.storage = self.storage
+        shutil.rmtree(self.location)
+
+    def mass_change(self, *boats, **data):
+        # Boat files are not in the admin form, which is tested through
+        # urlencoded submissions
+        upload = StringIO("%PDF")
+        upload.name = "plan.pdf"
+        request = RequestFactory().post('/', dict(data, _mass_change_plan='on', plan=upload))
+        request.user = self.user
+        ModelForm = modelform_factory(Boat, fields=('plan', 'length'))
+        admin.site._registry[Boat]._mass_change(request, ModelForm, [boat.pk for boat in boats])
+
+    def stored_files(self):
+        location = os.path.join(self.location, "plans")
+        return os.path.exists(location) and os.listdir(location) or []
+
+    def test_file_stored_once(self):
+        b1 = self.F.Boat()
+        b2 = self.F.Boat()
+        self.mass_change(b1, b2)
+        self.assertEqual(os.listdir(os.path.join(self.location, "plans")), ["plan.pdf"])
+        for boat in (b1, b2):
+            self.assertEqual(Boat.objects.get(pk=boat.pk).plan.name, "plans/plan.pdf")
+        # Per object path
+        with self.admin_options(mass_change_bulk_update=False):
+            self.mass_change(b1, b2)
+        self.assertEqual(len(os.listdir(os.path.join(self.location, "plans"))), 2)
+        self.assertEqual(Boat.objects.get(pk=b1.pk).plan.name, Boat.objects.get(pk=b2.pk).plan.name)
+
+    def test_file_not_stored_if_invalid(self):
+        b1 = self.F.Boat()
+        self.assertRaises(Exception, self.mass_change, b1, _mass_change_length='on', length="not a length")
+        self.assertEqual(self.stored_files(), [])
+
+    def test_file_deleted_on_failure(self):
+        def fail(sender, **kwargs):
+            raise Exception("Failed")
+        b1 = self.F.Boat()
+        pre_mass_change.connect(fail, sender=Boat)
+        try:
+            self.assertRaises(Exception, self.mass_change, b1)
+        finally:
+            pre_mass_change.disconnect(fail, sender=Boat)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_copy_files(self):
+        b1 = self.F.Boat()
+        b2 = self.F.Boat()
+        with self.admin_options(mass_change_copy_files=True):
+            self.mass_change(b1, b2)
+        self.assertEqual(len(os.listdir(os.path.join(self.location, "plans"))), 2)
+        plan1 = Boat.objects.get(pk=b1.pk).plan
+        plan2 = Boat.objects.get(pk=b2.pk).plan
+        self.assertNotEqual(plan1.name, plan2.name)
+        self.assertEqual(plan2.read(), "%PDF")
+
+
+class BulkUpdateTest(BaseTest):
+
+    def test_replace_in_bulk(self):
+        b1 = self.F.Boat(rigging=Boat.SLOOP)
+        b2 = self.F.Boat(rigging=Boat.CUTTER)
+        b3 = self.F.Boat(rigging=Boat.SLOOP)
+        b4 = self.F.Boat(rigging=Boat.SLOOP)  # Will not be edited
+        with self.admin_options(mass_change_batch_size=2):
+            form = self.get_massadmin_form(b1, b2, b3)
+            self.update_form(form, rigging=Boat.KETCH, length=12.5)
+            form.submit().follow()
+        for boat in (b1, b2, b3):
+            self.assertEqual(Boat.objects.get(pk=boat.pk).rigging, Boat.KETCH)
+            self.assertEqual(Boat.objects.get(pk=boat.pk).length, 12.5)
+        self.assertEqual(Boat.objects.get(pk=b4.pk).rigging, Boat.SLOOP)
+        # Changes are still logged
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), 3)
+
+    def test_commit_per_batch(self):
+        boats = [self.F.Boat(name="Boat %s" % i) for i in range(5)]
+        with self.admin_options(mass_change_batch_size=2, mass_change_commit_per_batch=True):
+            form = self.get_massadmin_form(*boats)
+            self.update_form(form, name=" (1967)", name_action="append", length=15)
+            form.submit().follow()
+            # Per object path
+            with self.admin_options(mass_change_bulk_update=False):
+                form = self.get_massadmin_form(*boats)
+                self.update_form(form, rigging=Boat.KETCH)
+                form.submit().follow()
+        for i, boat in enumerate(boats):
+            boat = Boat.objects.get(pk=boat.pk)
+            self.assertEqual(boat.name, "Boat %s (1967)" % i)
+            self.assertEqual(boat.length, 15)
+            self.assertEqual(boat.rigging, Boat.KETCH)
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), 10)
+
+    def test_log_summary(self):
+        b1 = self.F.Boat()
+        b2 = self.F.Boat()
+        with self.admin_options(mass_change_log_summary=True):
+            form = self.get_massadmin_form(b1, b2)
+            self.update_form(form, rigging=Boat.KETCH)
+            form.submit().follow()
+            # Per object path
+            with self.admin_options(mass_change_bulk_update=False):
+                form = self.get_massadmin_form(b1, b2)
+                self.update_form(form, name="Renamed", name_action="replace")
+                form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Renamed")
+        entries = LogEntry.objects.filter(action_flag=CHANGE).order_by('pk')
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].get_admin_url(), None)
+        self.assertTrue(entries[0].object_repr.startswith("Mass change of 2 boats (selection "))
+        self.assertEqual(entries[0].change_message, "Changed rigging.")
+        self.assertEqual(entries[1].change_message, "Changed name.")
+
+    def test_log_matched_objects(self):
+        b1 = self.F.Boat(architect="", length=10)
+        b2 = self.F.Boat(architect="Tabarly", length=20)
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, architect="Herbulot", architect_action="define", length=5, length_action="min")
+        form.submit().follow()
+        # Only b1 was defined, and no length was clamped
+        self.assertEqual([entry.object_id for entry in LogEntry.objects.filter(action_flag=CHANGE)], [unicode(b1.pk)])
+
+    def test_skip_up_to_date(self):
+        b1 = self.F.Boat(name="Pen Duick", rigging=Boat.SLOOP)
+        b2 = self.F.Boat(name="Joshua", rigging=Boat.KETCH)
+        b3 = self.F.Boat(name="Pen Duick", rigging=Boat.KETCH)
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, rigging=Boat.KETCH)
+        response = form.submit().follow()
+        self.assertContains(response, "1 boats changed, 2 already up to date.")
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+        # Only changed objects are logged
+        self.assertEqual([entry.object_id for entry in LogEntry.objects.filter(action_flag=CHANGE)], [unicode(b1.pk)])
+
+        with self.admin_options(mass_change_bulk_update=False):
+            form = self.get_massadmin_form(b1, b2, b3)
+            self.update_form(form, name="Joshua", name_action="replace")
+            response = form.submit().follow()
+        self.assertContains(response, "2 boats changed, 1 already up to date.")
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Joshua")
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), 3)
+
+    def test_batch_signals(self):
+        boats = [self.F.Boat(rigging=Boat.SLOOP) for i in range(3)]
+        sent = []
+
+        def on_mass_change(sender, queryset, pks, fields, actions, **kwargs):
+            sent.append((sorted(pks), fields, actions, [boat.rigging for boat in queryset]))
+        post_mass_change.connect(on_mass_change, sender=Boat)
+        try:
+            with self.admin_options(mass_change_batch_size=2):
+                form = self.get_massadmin_form(*boats)
+                self.update_form(form, rigging=Boat.KETCH)
+                form.submit().follow()
+        finally:
+            post_mass_change.disconnect(on_mass_change, sender=Boat)
+        self.assertEqual(sent, [
+            ([boats[0].pk, boats[1].pk], ('rigging', ), {'rigging': 'replace'}, [Boat.KETCH, Boat.KETCH]),
+            ([boats[2].pk], ('rigging', ), {'rigging': 'replace'}, [Boat.KETCH]),
+        ])
+
+    def test_suppress_row_signals(self):
+        saved = []
+        sent = []
+
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance.pk)
+
+        def on_mass_change(sender, pks, **kwargs):
+            sent.extend(pks)
+        b1 = self.F.Boat()
+        b2 = self.F.Boat()
+        signals.post_save.connect(on_save, sender=Boat)
+        post_mass_change.connect(on_mass_change, sender=Boat)
+        try:
+            with self.admin_options(mass_change_suppress_row_signals=True):
+                form = self.get_massadmin_form(b1, b2)
+                self.update_form(form, rigging=Boat.KETCH)
+                form.submit().follow()
+        finally:
+            signals.post_save.disconnect(on_save, sender=Boat)
+            post_mass_change.disconnect(on_mass_change, sender=Boat)
+        # Changed in bulk, without sending post_save
+        self.assertEqual(saved, [])
+        self.assertEqual(sorted(sent), sorted([b1.pk, b2.pk]))
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+
+    def test_save_signals_disable_bulk_update(self):
+        saved = []
+
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance.pk)
+        signals.post_save.connect(on_save, sender=Boat)
+        try:
+            b1 = self.F.Boat()
+            b2 = self.F.Boat()
+            del saved[:]
+            form = self.get_massadmin_form(b1, b2)
+            self.update_form(form, rigging=Boat.KETCH)
+            form.submit().follow()
+        finally:
+            signals.post_save.disconnect(on_save, sender=Boat)
+        self.assertEqual(sorted(saved), sorted([b1.pk, b2.pk]))
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+
+    def test_save_changed_fields_only(self):
+        saved = []
+
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance.pk)
+        b1 = self.F.Boat(rigging=Boat.SLOOP)
+        b2 = self.F.Boat(rigging=Boat.SLOOP)
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, rigging=Boat.KETCH)
+        signals.post_save.connect(on_save, sender=Boat)
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            form.submit()
+        finally:
+            connection.use_debug_cursor = None
+            signals.post_save.disconnect(on_save, sender=Boat)
+        updates = [query['sql'] for query in connection.queries[start:] if query['sql'].startswith('UPDATE "boats_boat"')]
+        self.assertEqual(len(updates), 2)
+        # Other columns are not written over
+        self.assertTrue(all('"rigging"' in sql and '"name"' not in sql for sql in updates))
+        self.assertEqual(sorted(saved), sorted([b1.pk, b2.pk]))
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+
+
+class PreviewTest(BaseTest):
+
+    def test_preview(self):
+        b1 = self.F.Boat(name="Pen Duick", rigging=Boat.KETCH)
+        b2 = self.F.Boat(name="x" * 99, architect="Tabarly", rigging=Boat.SLOOP)
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, architect="Herbulot", architect_action="define",
+                         name=" II", name_action="append", rigging=Boat.KETCH)
+        response = form.submit('_preview')
+        preview = response.context['preview']
+        self.assertEqual(preview['total'], 2)
+        counts = dict((field['name'], (field['changed'], field['unchanged'], field['too_long']))
+                      for field in preview['fields'])
+        self.assertEqual(counts, {
+            'architect': (1, 1, None),
+            'name': (2, 0, 1),
+            'rigging': (1, 1, None),
+        })
+        sample, values = preview['samples'][0]
+        self.assertEqual(sample, unicode(b1))
+        self.assertTrue((u"Name", u"Pen Duick", u"Pen Duick II") in values)
+        self.assertTrue((u"Architect", u"(None)", u"Herbulot") in values)
+        # Nothing changed yet
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick")
+        self.assertEqual(LogEntry.objects.count(), 0)
+
+    def test_save_after_preview(self):
+        b1 = self.F.Boat(name="Pen Duick")
+        b2 = self.F.Boat(name="Joshua")
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, name=" II", name_action="append")
+        response = form.submit('_preview')
+        response.forms['boat_form'].submit('_save').follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick II")
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Joshua II")
+
+
+class LazyWidgetsTest(BaseTest):
+
+    def setUp(self):
+        super(LazyWidgetsTest, self).setUp()
+        admin.site._registry[Boat].mass_change_lazy_widgets = True
+
+    def tearDown(self):
+        del admin.site._registry[Boat].mass_change_lazy_widgets
+
+    def test_widgets_loaded_on_demand(self):
+        b1 = self.F.Boat(name="Pen Duick", rigging=Boat.SLOOP)
+        b2 = self.F.Boat(name="Joshua", rigging=Boat.SLOOP)
+        form = self.get_massadmin_form(b1, b2)
+        # Only checkboxes are rendered
+        self.assertTrue('_mass_change_rigging' in form.fields)
+        self.assertTrue('rigging' not in form.fields)
+        self.assertTrue('_mass_change_name_action' not in form.fields)
+        response = self.app.get(reverse('admin:boats_boat_massadmin_field', args=('name',)), user=self.user)
+        self.assertTrue('name="name"' in response)
+        self.assertTrue('name="_mass_change_name_action"' in response)
+        self.assertTrue('name="_mass_change_name"' not in response)
+        # Fields without loaded widget don't submit their action
+        fields = form.submit_fields() + [('_mass_change_rigging', 'on'), ('rigging', Boat.KETCH), ('_save', 'Save')]
+        self.app.post(form.response.request.url, fields, user=self.user).follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Joshua")
+
+    def test_fieldsets_cached(self):
+        cache.clear()
+        b1 = self.F.Boat()
+        response = self.get_massadmin_form(b1).response
+        url = response.request.url
+        self.assertTrue('admin/includes/mass_fieldset.html' in [t.name for t in response.templates])
+        response = self.app.get(url, user=self.user)
+        self.assertTrue('admin/includes/mass_fieldset.html' not in [t.name for t in response.templates])
+        self.assertTrue('_mass_change_rigging' in response.forms['boat_form'].fields)
+
+    def test_raw_id_widgets(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        b1 = self.F.Boat(captain=c1)
+        with self.admin_options(mass_change_raw_id_threshold=1):
+            response = self.app.get(reverse('admin:boats_boat_massadmin_field', args=('captain',)), user=self.user)
+            # A text input, without lookup link as captains are not
+            # registered in the admin
+            self.assertTrue('<input type="text" name="captain"' in response)
+            response = self.app.get(reverse('admin:boats_boat_massadmin_field', args=('previous_captains',)), user=self.user)
+            self.assertTrue('<input type="text" name="previous_captains"' in response)
+            with self.admin_options(mass_change_lazy_widgets=False):
+                form = self.get_massadmin_form(b1)
+            self.update_form(form, captain=c2.pk)
+            form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).captain, c2)
+
+    def test_raw_id_widgets_keep_admin_formfield(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        b1 = self.F.Boat(captain=c1)
+        formfield_for_foreignkey = admin.site._registry[Boat].formfield_for_foreignkey
+
+        def restricted_formfield_for_foreignkey(db_field, request=None, **kwargs):
+            kwargs['queryset'] = Captain.objects.exclude(pk=c2.pk)
+            return formfield_for_foreignkey(db_field, request, **kwargs)
+        with self.admin_options(formfield_for_foreignkey=restricted_formfield_for_foreignkey,
+                                mass_change_raw_id_threshold=1):
+            response = self.app.get(reverse('admin:boats_boat_massadmin_field', args=('captain',)), user=self.user)
+            self.assertTrue('<input type="text" name="captain"' in response)
+            with self.admin_options(mass_change_lazy_widgets=False):
+                form = self.get_massadmin_form(b1)
+            # c2 can't be chosen
+            self.update_form(form, captain=c2.pk)
+            self.assertRaises(Exception, form.submit)
+        self.assertEqual(Boat.objects.get(pk=b1.pk).captain, c1)
+
+
+class MetricsTest(BaseTest):
+
+    def run_mass_change(self, **options):
+        boats = [self.F.Boat(rigging=Boat.SLOOP) for i in range(3)]
+        received = []
+
+        def on_metrics(sender, metrics, **kwargs):
+            received.append(metrics)
+        mass_change_metrics.connect(on_metrics, sender=Boat)
+        try:
+            with self.admin_options(mass_change_batch_size=2, **options):
+                form = self.get_massadmin_form(*boats)
+                self.update_form(form, rigging=Boat.KETCH)
+                response = form.submit().follow()
+        finally:
+            mass_change_metrics.disconnect(on_metrics, sender=Boat)
+        self.assertEqual(len(received), 1)
+        return received[0], response
+
+    def test_metrics_in_bulk(self):
+        metrics, response = self.run_mass_change()
+        self.assertEqual(metrics['batch_sizes'], [2, 1])
+        self.assertEqual((metrics['processed'], metrics['changed'], metrics['skipped']), (3, 3, 0))
+        phases = dict((phase['name'], phase) for phase in metrics['phases'])
+        self.assertEqual(set(phases), set(['plan', 'signals', 'validation', 'update', 'inlines', 'log']))
+        self.assertEqual(phases['log']['calls'], 2)
+        # Objects are loaded, then logged in bulk
+        self.assertTrue(phases['log']['queries'] >= 4)
+        self.assertTrue(metrics['queries'] >= sum(phase['queries'] for phase in metrics['phases']))
+        self.assertEqual(metrics['error'], None)
+        # Only shown in DEBUG mode
+        self.assertNotContains(response, "Mass change metrics:")
+
+    def test_metrics_by_object(self):
+        with override_settings(DEBUG=True):
+            metrics, response = self.run_mass_change(mass_change_bulk_update=False)
+        phases = dict((phase['name'], phase) for phase in metrics['phases'])
+        self.assertTrue(set(['fetch', 'validation', 'save', 'save_m2m', 'log']) <= set(phases))
+        self.assertEqual(phases['save']['calls'], 3)
+        # Only the UPDATE of changed fields
+        self.assertEqual(phases['save']['queries'], 3)
+        self.assertContains(response, "Mass change metrics:")
+
+
+class LockingTest(BaseTest):
+
+    def setUp(self):
+        super(LockingTest, self).setUp()
+        boat_admin = admin.site._registry[Boat]
+        boat_admin.mass_change_lock_rows = True
+        boat_admin.mass_change_batch_size = 2
+
+    def tearDown(self):
+        boat_admin = admin.site._registry[Boat]
+        del boat_admin.mass_change_lock_rows
+        del boat_admin.mass_change_batch_size
+
+    def test_lock_rows(self):
+        boats = [self.F.Boat(rigging=Boat.SLOOP) for i in range(3)]
+        received = []
+
+        def on_metrics(sender, metrics, **kwargs):
+            received.append(metrics)
+        mass_change_metrics.connect(on_metrics, sender=Boat)
+        try:
+            form = self.get_massadmin_form(*boats)
+            self.update_form(form, rigging=Boat.KETCH)
+            form.submit().follow()
+        finally:
+            mass_change_metrics.disconnect(on_metrics, sender=Boat)
+        phases = dict((phase['name'], phase) for phase in received[0]['phases'])
+        # One lock per batch
+        self.assertEqual(phases['lock']['calls'], 2)
+        for boat in boats:
+            self.assertEqual(Boat.objects.get(pk=boat.pk).rigging, Boat.KETCH)
+
+    def test_skip_locked(self):
+        b1 = self.F.Boat(name="Pen Duick", rigging=Boat.SLOOP)
+        b2 = self.F.Boat(name="Joshua", rigging=Boat.SLOOP)
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, rigging=Boat.KETCH)
+        # SQLite has no SELECT ... FOR UPDATE: pretending it supports NOWAIT
+        # makes each lock fail, as if rows were locked by someone else
+        features = connection.features
+        saved = features.has_select_for_update, features.has_select_for_update_nowait
+        features.has_select_for_update = features.has_select_for_update_nowait = True
+        try:
+            with self.admin_options(mass_change_skip_locked=True):
+                response = form.submit().follow()
+        finally:
+            features.has_select_for_update, features.has_select_for_update_nowait = saved
+        self.assertContains(response, "2 boats were skipped, as they were being changed by someone else.")
+        self.assertContains(response, "0 boats changed, 0 already up to date.")
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.SLOOP)
+        self.assertEqual(Boat.objects.get(pk=b2.pk).rigging, Boat.SLOOP)
+
+
+class PlanTest(BaseTest):
+
+    def test_plan(self):
+        boat = self.F.Boat()
+        form = self.get_massadmin_form(boat)
+        self.update_form(form, name=" II", name_action="append", length="2.5", length_action="add")
+        request = RequestFactory().post('/', urllib.urlencode(form.submit_fields()),
+                                        content_type='application/x-www-form-urlencoded')
+        request.user = self.user
+        boat_admin = admin.site._registry[Boat]
+        plan = boat_admin.get_mass_change_plan(request, boat_admin.get_mass_form(request))
+        self.assertEqual(plan.fields, ('name', 'length'))
+        self.assertEqual(dict(plan.actions), {'name': 'append', 'length': 'add'})
+        self.assertEqual(plan.operands, {'length': 2.5})
+        self.assertEqual(plan.formsets, ())
+        # Forms only hold mass changed fields
+        form = plan.get_form(boat)
+        self.assertEqual(form.fields.keys(), ['name', 'length'])
+        # Their data can be altered without altering the plan's
+        form.data['name'] = 'Changed'
+        self.assertEqual(plan.data['name'], ' II')
+
+    def mass_change(self, ModelForm, boats, bulk_update=True, **data):
+        request = RequestFactory().post('/', data)
+        request.user = self.user
+        with self.admin_options(mass_change_bulk_update=bulk_update) as boat_admin:
+            boat_admin._mass_change(request, ModelForm, [boat.pk for boat in boats])
+
+    def test_values_cleaned_by_custom_forms(self):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        boats = [self.F.Boat(captain=c1) for i in range(2)]
+
+        class BoatForm(forms.ModelForm):
+            class Meta:
+                model = Boat
+                fields = ('captain', )
+
+            def __init__(self, *args, **kwargs):
+                super(BoatForm, self).__init__(*args, **kwargs)
+                self.fields['captain'].queryset = Captain.objects.filter(pk=c1.pk)
+
+        for bulk_update in (True, False):
+            self.assertRaises(Exception, self.mass_change, BoatForm, boats, bulk_update=bulk_update,
+                              _mass_change_captain='on', captain=c2.pk)
+        for boat in boats:
+            self.assertEqual(Boat.objects.get(pk=boat.pk).captain, c1)
+
+    def test_unique_checked(self):
+        b1 = self.F.Boat(name="Pen Duick", architect="Tabarly")
+        b2 = self.F.Boat(name="Pen Duick II", architect="Tabarly")
+        ModelForm = modelform_factory(Boat, fields=('name', 'architect'))
+        Boat._meta.unique_together = (('name', 'architect'), )
+        try:
+            for bulk_update in (True, False):
+                self.assertRaises(Exception, self.mass_change, ModelForm, [b2], bulk_update=bulk_update,
+                                  _mass_change_name='on', _mass_change_name_action='replace', name="Pen Duick",
+                                  _mass_change_architect_action='replace')
+        finally:
+            Boat._meta.unique_together = ()
+        self.assertEqual(Boat.objects.get(pk=b2.pk).name, "Pen Duick II")
+
+
+class QueryCountTest(BaseTest):
+
+    def count_captain_queries(self, n_boats):
+        c1 = self.F.Captain()
+        c2 = self.F.Captain()
+        boats = [self.F.Boat(captain=c1, previous_captains=[c1]) for i in range(n_boats)]
+        form = self.get_massadmin_form(*boats)
+        self.update_form(form, name="Renamed", previous_captains=[c2.pk], previous_captains_action="replace")
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            with self.admin_options(mass_change_bulk_update=False):
+                form.submit()
+        finally:
+            connection.use_debug_cursor = None
+        for boat in boats:
+            self.assertEqual(list(Boat.objects.get(pk=boat.pk).previous_captains.all()), [c2])
+        # Not counting how many captains there are, to choose their widget
+        # (see `MassAdmin.mass_change_raw_id_threshold`)
+        return len([query for query in connection.queries[start:]
+                    if query['sql'].startswith('SELECT') and 'FROM "boats_captain"' in query['sql']
+                    and not query['sql'].startswith('SELECT COUNT(*)')])
+
+    def test_objects_loaded_with_constant_queries(self):
+        # Chosen captains are cleaned once, and current previous captains of
+        # all boats are loaded at once
+        self.assertEqual(self.count_captain_queries(2), 2)
+        self.assertEqual(self.count_captain_queries(6), 2)
+
+
+class SelectionTest(BaseTest):
+
+    def test_selection_token(self):
+        b1 = self.F.Boat()
+        b2 = self.F.Boat()
+        form = self.get_massadmin_form(b1, b2)
+        # Selected ids are not in the URL anymore
+        self.assertNotIn("%s," % b1.pk, form.action)
+        self.update_form(form, rigging=Boat.KETCH)
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+        self.assertEqual(Boat.objects.get(pk=b2.pk).rigging, Boat.KETCH)
+
+    def test_unknown_token(self):
+        self.F.Boat()
+        url = reverse('admin:boats_boat_massadmin', args=('unknown',))
+        response = self.app.get(url, user=self.user)
+        self.assertRedirects(response, reverse('admin:boats_boat_changelist'))
+
+    def test_expired_token(self):
+        b1 = self.F.Boat(rigging=Boat.SLOOP)
+        with self.admin_options(mass_change_selection_timeout=-1):
+            form = self.app.get(reverse('admin:boats_boat_changelist'), user=self.user).forms['changelist-form']
+            form.get(ACTION_CHECKBOX_NAME, index=0).checked = True
+            form['action'] = 'mass_change_selected'
+            response = form.submit().follow()
+        self.assertRedirects(response, reverse('admin:boats_boat_changelist'))
+
+    def test_select_across(self):
+        sloops = [self.F.Boat(rigging=Boat.SLOOP, name="Boat %s" % i) for i in range(5)]
+        cutter = self.F.Boat(rigging=Boat.CUTTER)
+        with self.admin_options(list_per_page=2, mass_change_batch_size=2):
+            url = "%s?rigging__exact=%s" % (reverse('admin:boats_boat_changelist'), Boat.SLOOP)
+            form = self.app.get(url, user=self.user).forms['changelist-form']
+            form['action'] = 'mass_change_selected'
+            # Like the admin javascript, check objects of the current page
+            for index in range(len(form.fields[ACTION_CHECKBOX_NAME])):
+                form.get(ACTION_CHECKBOX_NAME, index=index).checked = True
+            form['select_across'] = '1'
+            response = form.submit().follow()
+            self.assertIn("Mass change of 5 boats", response)
+            # A boat created since the selection also matches the filters
+            sloops.append(self.F.Boat(rigging=Boat.SLOOP))
+            form = response.forms['boat_form']
+            # Changed objects do not match the filters anymore, but this
+            # does not prevent next batches from being changed
+            self.update_form(form, rigging=Boat.KETCH)
+            response = form.submit().follow()
+            self.assertIn("6 boats changed, 0 already up to date.", response)
+        for boat in sloops:
+            self.assertEqual(Boat.objects.get(pk=boat.pk).rigging, Boat.KETCH)
+        self.assertEqual(Boat.objects.get(pk=cutter.pk).rigging, Boat.CUTTER)
+
+    def test_select_across_from_later_page(self):
+        sloops = [self.F.Boat(rigging=Boat.SLOOP, name="Boat %s" % i) for i in range(7)]
+        with self.admin_options(list_per_page=2):
+            url = "%s?rigging__exact=%s&p=3" % (reverse('admin:boats_boat_changelist'), Boat.SLOOP)
+            form = self.app.get(url, user=self.user).forms['changelist-form']
+            form['action'] = 'mass_change_selected'
+            form.get(ACTION_CHECKBOX_NAME, index=0).checked = True
+            form['select_across'] = '1'
+            response = form.submit().follow()
+            self.assertIn("Mass change of 7 boats", response)
+            # The fourth page does not exist anymore
+            for boat in sloops[5:]:
+                boat.delete()
+            form = response.forms['boat_form']
+            self.update_form(form, rigging=Boat.KETCH)
+            response = form.submit().follow()
+            self.assertIn("5 boats changed, 0 already up to date.", response)
+        for boat in sloops[:5]:
+            self.assertEqual(Boat.objects.get(pk=boat.pk).rigging, Boat.KETCH)
+
+    def test_encode_pks(self):
+        pks = [1, 2, 3, 10, 500, 501, 100000]
+        data = selection.encode_pks(Boat, reversed(pks))
+        self.assertEqual(selection.decode_pks(Boat, data), pks)
+        # Contiguous ids are packed in a few bytes
+        self.assertTrue(len(selection.encode_pks(Boat, range(1, 100001))) < 1000)
+
+    def test_encode_string_pks(self):
+        pks = [u"3f2504e0-4f89-11d3-9a0c-0305e82c3301", u"B\xe9n\xe9teau"]
+        data = selection.encode_pks(Session, pks)
+        self.assertEqual(selection.decode_pks(Session, data), pks)
+
+
+class JobTest(BaseTest):
+
+    def setUp(self):
+        super(JobTest, self).setUp()
+        boat_admin = admin.site._registry[Boat]
+        boat_admin.mass_change_job_threshold = 2
+        # sqlite in memory databases are not shared between threads
+        boat_admin.mass_change_jobs_in_thread = False
+
+    def tearDown(self):
+        boat_admin = admin.site._registry[Boat]
+        del boat_admin.mass_change_job_threshold
+        del boat_admin.mass_change_jobs_in_thread
+
+    def test_job(self):
+        b1 = self.F.Boat(rigging=Boat.SLOOP)
+        b2 = self.F.Boat(rigging=Boat.SLOOP)
+        b3 = self.F.Boat(rigging=Boat.KETCH)
+        form = self.get_massadmin_form(b1, b2, b3)
+        self.update_form(form, rigging=Boat.KETCH)
+        response = form.submit()
+        # Nothing is changed yet
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.SLOOP)
+        job = MassChangeJob.objects.get()
+        # Reloading the job page does not submit the mass change again
+        self.assertRedirects(response, reverse('admin:boats_boat_massadmin_job_status', args=(job.pk,)))
+        progress_url = reverse('admin:boats_boat_massadmin_job', args=(job.pk,))
+        self.assertIn(progress_url, response.follow())
+        progress = simplejson.loads(self.app.get(progress_url, user=self.user).body)
+        self.assertEqual((progress['status'], progress['total'], progress['processed']), ('pending', 3, 0))
+
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+        self.assertEqual(Boat.objects.get(pk=b2.pk).rigging, Boat.KETCH)
+        progress = simplejson.loads(self.app.get(progress_url, user=self.user).body)
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual((progress['processed'], progress['changed'], progress['untouched'], progress['failed']),
+                         (3, 2, 1, 0))
+
+    def test_job_run_once(self):
+        b1 = self.F.Boat(name="Pen Duick")
+        b2 = self.F.Boat(name="Joshua")
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, name=" II", name_action="append")
+        form.submit()
+        # Two workers got the job while it was pending
+        job = MassChangeJob.objects.get()
+        stale_job = MassChangeJob.objects.get()
+        self.assertTrue(run_job(job))
+        self.assertFalse(run_job(stale_job))
+        self.assertEqual(Boat.objects.get(pk=b1.pk).name, "Pen Duick II")
+        self.assertEqual(MassChangeJob.objects.get().status, MassChangeJob.DONE)
+
+    def test_failed_job(self):
+        b1 = self.F.Boat(rigging=Boat.SLOOP)
+        b2 = self.F.Boat(rigging=Boat.SLOOP)
+        form = self.get_massadmin_form(b1, b2)
+        self.update_form(form, length="not a length")
+        form.submit()
+        run_pending_jobs()
+        job = MassChangeJob.objects.get()
+        self.assertEqual(job.status, MassChangeJob.FAILED)
+        self.assertTrue(job.error)
+
+    def test_under_threshold(self):
+        b1 = self.F.Boat(rigging=Boat.SLOOP)
+        form = self.get_massadmin_form(b1)
+        self.update_form(form, rigging=Boat.KETCH)
+        form.submit().follow()
+        self.assertEqual(Boat.objects.get(pk=b1.pk).rigging, Boat.KETCH)
+        self.assertFalse(MassChangeJob.objects.exists())
+
+
+class BenchmarkTest(BaseTest):
+
+    def test_benchmark(self):
+        report = run_benchmark(sizes=[3], actions=['replace', 'inline_bulk'])
+        self.assertEqual([(result['action'], result['size'], result['status_code']) for result in report['results']],
+                         [('replace', 3, 302), ('inline_bulk', 3, 302)])
+        self.assertTrue(all(result['queries'] > 0 for result in report['results']))
+        self.assertEqual(Boat.objects.filter(rigging=Boat.KETCH).count(), 0)
+        self.assertEqual(BoatToRace.objects.count(), 3)
+
+    @skipUnless(os.environ.get('MASSADMIN_BENCHMARK_SIZES'), "MASSADMIN_BENCHMARK_SIZES is not set")
+    def test_full_benchmark(self):
+        sizes = [int(size) for size in os.environ['MASSADMIN_BENCHMARK_SIZES'].split(',')]
+        report = run_benchmark(sizes=sizes)
+        with open(os.environ.get('MASSADMIN_BENCHMARK_OUTPUT', 'massadmin-benchmark.json'), 'w') as output:
+            simplejson.dump(report, output, indent=2)